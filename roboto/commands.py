@@ -1,9 +1,10 @@
 import asyncio
-from enum import Enum
+from collections import deque
+from itertools import islice
+from enum import Enum, IntEnum
 import discord
 import irc3
 from discord import ChannelType
-from sqlalchemy import orm
 from sqlalchemy.exc import DBAPIError
 from roboto import config, loop, logger
 from roboto import games
@@ -11,7 +12,10 @@ from roboto import media
 from roboto import overwatch
 from roboto import text
 from roboto.exc import ValidationError, InvalidArgument
-from roboto.model import Session, User, UserMessage, TaskSource, log, Server
+from roboto.model import TaskSource, log, Server
+from roboto.db import database
+from roboto.outbound import outbox
+from roboto.recorder import recorder
 
 
 def parse_message(msg: str):
@@ -19,14 +23,14 @@ def parse_message(msg: str):
     :return:
     :rtype: TaskState
     """
+    if not registry.is_command(msg):
+        # Special case for record since we want the complete string
+        if not msg or msg.isspace():
+            return
+        return TaskState(Commands.record, [msg])
     args = msg.split()
-    if not args:
-        return
     cmd = Commands.find_command(args[0])
-    if not cmd:
-        return
     if cmd == Commands.record:
-        # Special case for record since we want the complete string
         return TaskState(cmd, [msg])
     return TaskState(cmd, args[1:])
 
@@ -44,6 +48,97 @@ def helpstr(help_msg: str, num_args=None):
     return tags_decorator
 
 
+def task_timeout(seconds):
+    """ Overrides the configured task_timeout for the decorated do_* method, None disables the timeout
+
+    :return:
+    :rtype: callable
+    """
+    def timeout_decorator(func):
+        func.__timeout__ = seconds
+        return func
+    return timeout_decorator
+
+
+class TaskPriority(IntEnum):
+    """
+    Dispatcher lanes, lower values are executed first
+    """
+    interactive = 0
+    background = 1
+
+
+def task_priority(priority: TaskPriority):
+    """ Sets the dispatcher lane for the decorated do_* method, interactive is the default
+
+    :return:
+    :rtype: callable
+    """
+    def priority_decorator(func):
+        func.__priority__ = priority
+        return func
+    return priority_decorator
+
+
+def coalescible(debounce=None, max_delay=None):
+    """ Marks the decorated do_* method as idempotent. A new task for a server that already has the
+    same task pending is merged into the pending one. Pending tasks are held until no new request
+    arrived for debounce seconds, but never longer than max_delay seconds. None uses the configured
+    coalesce_debounce / coalesce_max_delay values.
+
+    :return:
+    :rtype: callable
+    """
+    def coalesce_decorator(func):
+        func.__coalesce__ = (debounce, max_delay)
+        return func
+    return coalesce_decorator
+
+
+def internal(func):
+    """ Marks the decorated do_* method as internal, it can only be queued by the bot itself and isn't
+    reachable as a chat command
+
+    :rtype: callable
+    """
+    func.__internal__ = True
+    return func
+
+
+def admin(func):
+    """ Marks the decorated do_* method as restricted to the users listed in the discord_admins /
+    twitch_admins config values, requests by anyone else are discarded before they're queued
+
+    :rtype: callable
+    """
+    func.__admin__ = True
+    return func
+
+
+class CoalescedTask(object):
+    """
+    A held back coalescible task along with the requests merged into it
+    """
+
+    def __init__(self, task, first_seen, max_delay):
+        self.task = task
+        self.merged = 0
+        self.deadline = first_seen + max_delay
+        self.timer = None
+
+
+class OverflowPolicy(Enum):
+    """
+    What to do with a new task when its lane is full
+    """
+    # Discard the new task
+    drop = 1
+    # Merge the new task into an identical pending one, otherwise wait for space
+    coalesce = 2
+    # Wait for the lane to make space
+    block = 3
+
+
 class Commands(Enum):
     """
     Enum for all possible events/tasks that the system can handle
@@ -60,6 +155,10 @@ class Commands(Enum):
     eight = 9
     talk = 10
     record = 11
+    search = 12
+    queue = 13
+    shuffle = 14
+    skip = 2
     rank = 50
     yt = 51
     rebuild_markov = 80
@@ -69,8 +168,8 @@ class Commands(Enum):
 
     @staticmethod
     def find_command(txt: str):
-        """ Find the matching enum value from the txt value passed in, leading command prefixes are
-        discarded for the matching.
+        """ Find the matching enum value for a chat message token. The token must start with the command
+        prefix, anything else, like an unknown command, maps to Commands.record.
 
         :param txt:
         :return:
@@ -78,13 +177,110 @@ class Commands(Enum):
         """
         if not txt:
             return None
-        prefix = config.get("prefix", "!")
-        if txt[0] == prefix:
-            txt = txt[1:]
-        for name, member in Commands.__members__.items():
-            if name == txt.lower():
-                return member
-        return Commands.record
+        return registry.find(txt)
+
+
+class CommandInfo(object):
+    """
+    Precomputed details of a command handler
+    """
+    __slots__ = ("command", "handler", "num_args", "help", "priority", "timeout", "has_timeout", "coalesce",
+                 "internal", "admin")
+
+    def __init__(self, command, handler):
+        self.command = command
+        self.handler = handler
+        self.num_args = getattr(handler, "__num_args__", None)
+        self.help = getattr(handler, "__help__", None)
+        self.priority = getattr(handler, "__priority__", TaskPriority.interactive)
+        self.has_timeout = hasattr(handler, "__timeout__")
+        self.timeout = getattr(handler, "__timeout__", None)
+        self.coalesce = getattr(handler, "__coalesce__", None)
+        self.internal = getattr(handler, "__internal__", False)
+        self.admin = getattr(handler, "__admin__", False)
+
+
+class CommandRegistry(object):
+    """
+    Lookup tables for the commands and their handlers. Built once the dispatcher exists and
+    rebuilt using load whenever the config changes.
+    """
+
+    def __init__(self):
+        self.prefix = "!"
+        self._names = dict()
+        self._commands = dict()
+        self._help = dict()
+        self._help_all = []
+        # TaskSource -> user ids allowed to run admin commands
+        self._admins = dict()
+
+    def load(self, dispatcher):
+        """ (Re)build the lookup tables for the dispatchers do_* handlers
+
+        :param dispatcher:
+        :type dispatcher: CommandDispatcher
+        """
+        self.prefix = config.get("prefix", "!")
+        self._admins = {source: {u.strip().lower() for u in config.get("{}_admins".format(source.name), "").split(",")
+                                 if u.strip()}
+                        for source in TaskSource}
+        self._commands = {member: CommandInfo(member, getattr(dispatcher, "do_{}".format(member.name), None))
+                          for member in Commands}
+        self._names = {name.lower(): member for name, member in Commands.__members__.items()
+                       if not self._commands[member].internal}
+        self._help = dict()
+        for k, v in type(dispatcher).__dict__.items():
+            help_msg = getattr(getattr(v, "__func__", v), "__help__", None)
+            if k.startswith("do_") and help_msg:
+                self._help[k[3:]] = "{}{}: {}".format(self.prefix, k[3:], help_msg)
+        self._help_all = list(self._help.values())
+
+    def is_command(self, txt: str) -> bool:
+        return txt[:1] == self.prefix
+
+    def find(self, txt: str):
+        """ Find the command for a chat message token, anything that isn't a known command is recorded
+
+        :rtype: Commands
+        """
+        if not self.is_command(txt):
+            return Commands.record
+        return self._names.get(txt[1:].lower(), Commands.record)
+
+    def get(self, command):
+        """
+
+        :rtype: CommandInfo
+        """
+        return self._commands.get(command)
+
+    def is_allowed(self, task) -> bool:
+        """ Check whether the user that issued the task may run its command
+
+        :type task: TaskState
+        """
+        info = self._commands.get(task.command)
+        if info is None or not info.admin:
+            return True
+        user_id = task.get_user_id()
+        return user_id is not None and str(user_id).lower() in self._admins.get(task.source, ())
+
+    def help(self, cmd_name=None, help_sep=" :100: ") -> str:
+        if cmd_name:
+            try:
+                cmd_name = cmd_name.name
+            except AttributeError:
+                pass
+            if cmd_name.startswith("do_"):
+                cmd_name = cmd_name[3:]
+            elif self.is_command(cmd_name):
+                cmd_name = cmd_name[1:]
+            cmd_name = cmd_name.lower()
+            # Aliases like skip share the help of the command they point to
+            member = self._names.get(cmd_name)
+            return self._help.get(cmd_name) or (self._help.get(member.name, "") if member else "")
+        return help_sep.join(self._help_all)
 
 
 class TaskState(object):
@@ -121,13 +317,9 @@ class TaskState(object):
             raise ValidationError("Discord client already set")
         self._client_discord = client
 
-    def get_user(self, session: orm.Session):
-        if self.source == TaskSource.discord:
-            return User.get(session, discord_id=self._user)
-        elif self.source == TaskSource.twitch:
-            return User.get(session, twitch_id=self._user)
-        else:
-            raise ValidationError("No _user value to search with")
+    def get_user_id(self):
+        """ The raw platform specific user id """
+        return self._user
 
     def get_client_discord(self) -> discord.Client:
         return self._client_discord
@@ -154,72 +346,251 @@ class CommandDispatcher(asyncio.Queue):
     Central event hub where tasks get routed between users and requested services
     """
 
-    def __init__(self, lop):
+    def __init__(self, lop, workers=4, timeout=30.0, background_size=1000, overflow=OverflowPolicy.block):
         super().__init__()
         self._loop = lop
         self._running = False
+        self.workers = workers
+        self.timeout = timeout
+        self.overflow = overflow
+        # Pending tasks per server and lane, each server only ever has a single task executing
+        self._server_tasks = dict()
+        self._active = set()
+        # Best lane each server is currently queued with in _ready
+        self._ready_priority = dict()
+        # Servers with pending tasks waiting for a free worker, ordered by lane
+        self._ready = asyncio.PriorityQueue()
+        self._ready_seq = 0
+        # Bounds for the lanes, the interactive lane is unbounded
+        self._lane_limits = {TaskPriority.background: asyncio.Semaphore(background_size)}
+        self.dropped = 0
+        # Coalescible tasks being held back, keyed by (command, server_id)
+        self._coalesced = dict()
+        self.coalesce_debounce = 2.0
+        self.coalesce_max_delay = 30.0
+        self.merged = 0
+
+    def configure(self):
+        """ Apply the config values, must be called before the consumer is started """
+        self.workers = max(1, int(config.get("dispatcher_workers", self.workers)))
+        self.timeout = float(config.get("task_timeout", self.timeout))
+        self.overflow = OverflowPolicy[config.get("background_overflow", self.overflow.name)]
+        self._lane_limits[TaskPriority.background] = asyncio.Semaphore(
+            int(config.get("background_queue_size", 1000)))
+        self.coalesce_debounce = float(config.get("coalesce_debounce", self.coalesce_debounce))
+        self.coalesce_max_delay = float(config.get("coalesce_max_delay", self.coalesce_max_delay))
 
     async def task_consumer(self):
-        """ Background coroutine that will consume the task queue and execute the
-        appropriate method.
+        """ Background coroutine that will consume the task queue and hand the tasks to the
+        worker pool. Tasks for the same server execute in order per lane, different servers run in
+        parallel and interactive tasks are always picked before background ones.
 
         :return:
         """
         self._running = True
+        workers = [asyncio.ensure_future(self._worker(), loop=self._loop) for _ in range(self.workers)]
+        try:
+            while self._running:
+                try:
+                    task = await self.get()
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(0.1)
+                else:
+                    self._schedule(task)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    def _schedule(self, task: TaskState):
+        priority = self.get_priority(task)
+        try:
+            lanes = self._server_tasks[task.server_id]
+        except KeyError:
+            lanes = self._server_tasks[task.server_id] = tuple(deque() for _ in TaskPriority)
+        lanes[priority].append(task)
+        if task.server_id not in self._active:
+            self._make_ready(task.server_id, priority)
+
+    def _make_ready(self, server_id, priority: TaskPriority):
+        if priority < self._ready_priority.get(server_id, len(TaskPriority)):
+            self._ready_priority[server_id] = priority
+            self._ready_seq += 1
+            self._ready.put_nowait((priority, self._ready_seq, server_id))
+
+    def _next_task(self, server_id):
+        """ Pop the next task for the server from the highest priority lane that has one
+
+        :return: (TaskPriority, TaskState) or (None, None)
+        """
+        for priority, lane in zip(TaskPriority, self._server_tasks.get(server_id, ())):
+            if lane:
+                return priority, lane.popleft()
+        return None, None
+
+    async def _worker(self):
         while self._running:
+            _, _, server_id = await self._ready.get()
+            if server_id in self._active:
+                # Stale entry, the server is re-queued once its running task completes
+                continue
+            self._ready_priority.pop(server_id, None)
+            priority, task = self._next_task(server_id)
+            if task is None:
+                continue
+            self._release_lane(priority)
+            self._active.add(server_id)
             try:
-                task = await self.get()
-            except asyncio.QueueEmpty:
-                await asyncio.sleep(0.1)
-            else:
-                try:
-                    await self.execute_task(task)
-                except Exception as err:
-                    log.exception("Error executing task")
+                await self._run_task(task)
+            finally:
+                self._active.discard(server_id)
+                lanes = self._server_tasks[server_id]
+                for priority, lane in zip(TaskPriority, lanes):
+                    if lane:
+                        # Requeue behind the others so busy servers can't starve them
+                        self._make_ready(server_id, priority)
+                        break
+                else:
+                    del self._server_tasks[server_id]
+
+    def get_priority(self, task: TaskState) -> TaskPriority:
+        info = registry.get(task.command)
+        return info.priority if info else TaskPriority.interactive
+
+    def _coalesce_opts(self, task: TaskState):
+        """
+
+        :return: (debounce, max_delay) or None if the task can't be coalesced
+        """
+        info = registry.get(task.command)
+        if info is None or info.coalesce is None:
+            return None
+        debounce, max_delay = info.coalesce
+        if debounce is None:
+            debounce = self.coalesce_debounce
+        if max_delay is None:
+            max_delay = self.coalesce_max_delay
+        return debounce, max_delay
+
+    def _hold(self, task: TaskState, debounce, max_delay):
+        """ Hold back a coalescible task until it is released by the debounce timer """
+        now = self._loop.time()
+        key = (task.command, task.server_id)
+        pending = self._coalesced[key] = CoalescedTask(task, now, max_delay)
+        pending.timer = self._loop.call_at(min(now + debounce, pending.deadline), self._release_coalesced, key)
+
+    def _merge(self, task: TaskState, debounce) -> bool:
+        """ Merge the task into a matching held back or queued task, restarting the debounce timer
+
+        :return: True if a matching task was found
+        """
+        key = (task.command, task.server_id)
+        pending = self._coalesced.get(key)
+        if pending is not None:
+            pending.merged += 1
+            pending.timer.cancel()
+            pending.timer = self._loop.call_at(
+                min(self._loop.time() + debounce, pending.deadline), self._release_coalesced, key)
+        elif not self._is_pending(task, match_args=False):
+            return False
+        self.merged += 1
+        log.debug("Merged task: {}".format(task))
+        return True
 
-    async def add_task(self, task: TaskState) -> None:
+    def _release_coalesced(self, key):
+        pending = self._coalesced.pop(key)
+        log.debug("Releasing task: {} merged: {}".format(pending.task, pending.merged))
+        self.put_nowait(pending.task)
+
+    def _task_timeout(self, task: TaskState):
+        info = registry.get(task.command)
+        if info is None or not info.has_timeout:
+            return self.timeout
+        return info.timeout
+
+    async def _run_task(self, task: TaskState):
+        try:
+            await asyncio.wait_for(self.execute_task(task), self._task_timeout(task))
+        except asyncio.TimeoutError:
+            log.error("Timed out executing task: {}".format(task))
+        except Exception:
+            log.exception("Error executing task")
+
+    def _release_lane(self, priority: TaskPriority):
+        try:
+            self._lane_limits[priority].release()
+        except KeyError:
+            pass
+
+    def _is_pending(self, task: TaskState, match_args=True) -> bool:
+        lanes = self._server_tasks.get(task.server_id, ())
+        return any(t.command == task.command and (not match_args or t.args == task.args)
+                   for lane in lanes for t in lane)
+
+    async def add_task(self, task: TaskState) -> bool:
+        """ Queue a task, tasks in a full bounded lane are handled using the configured overflow policy
+
+        :return: False if the task was discarded
+        """
+        if task.command == Commands.record:
+            # Handed to the recorder right away instead of waiting in the server lanes, so everything
+            # received before shutdown is written out by recorder.close. Its queue bounds the backlog.
+            return await self.do_record(task)
+        if not registry.is_allowed(task):
+            log.warning("Denied admin task: {} User: {}".format(task, task.get_user_id()))
+            return False
+        priority = self.get_priority(task)
+        coalesce_opts = self._coalesce_opts(task)
+        if coalesce_opts and self._merge(task, coalesce_opts[0]):
+            return False
+        limit = self._lane_limits.get(priority)
+        if limit is not None:
+            if limit.locked():
+                if self.overflow == OverflowPolicy.drop:
+                    self.dropped += 1
+                    log.warning("Lane {} full, dropped task: {}".format(priority.name, task))
+                    return False
+                if self.overflow == OverflowPolicy.coalesce and self._is_pending(task):
+                    log.debug("Coalesced task: {}".format(task))
+                    return False
+            await limit.acquire()
+        if coalesce_opts:
+            # A matching task may have arrived while waiting for the lane
+            if self._merge(task, coalesce_opts[0]):
+                self._release_lane(priority)
+                return False
+            log.info("Holding task: {}".format(task))
+            self._hold(task, *coalesce_opts)
+            return True
         log.info("Adding task: {}".format(task))
         await self.put(task)
+        return True
 
-    @classmethod
-    def gen_help(cls, cmd_name=None, help_sep=" :100: ") -> str:
-        prefix = config.get("prefix", "!")
-        if cmd_name:
-            try:
-                cmd_name = cmd_name.name
-            except AttributeError:
-                pass
-            if not cmd_name.startswith("do_"):
-                cmd_name = "do_{}".format(cmd_name)
-        resp = []
-        for k, v in cls.__dict__.items():
-            if k.startswith("do_"):
-                if cmd_name and k != cmd_name:
-                    continue
-                try:
-                    resp.append("{}{}: {}".format(prefix, k[3:], v.__help__))
-                except AttributeError:
-                    pass
-        if len(resp) > 1:
-            return help_sep.join(resp)
-        return resp[0]
+    def stats(self) -> dict:
+        return {
+            "servers": len(self._server_tasks),
+            "running": len(self._active),
+            "queued": sum(len(lane) for lanes in self._server_tasks.values() for lane in lanes),
+            "held": len(self._coalesced),
+            "merged": self.merged,
+            "dropped": self.dropped
+        }
+
+    @staticmethod
+    def gen_help(cmd_name=None, help_sep=" :100: ") -> str:
+        return registry.help(cmd_name, help_sep)
 
     async def execute_task(self, task: TaskState):
-        print("Got task.. {}".format(task))
-        try:
-            fn = getattr(self, "do_{}".format(task.command.name))
-        except AttributeError:
+        log.debug("Got task.. {}".format(task))
+        info = registry.get(task.command)
+        if info is None or info.handler is None:
             logger.error("Got invalid/unimplemented task: {}".format(task.command))
-        else:
-            try:
-                if fn.__num_args__ is not None:
-                    if fn.__num_args__ != len(task.args):
-                        raise InvalidArgument("Your arguments are invalid")
-            except AttributeError:
-                pass
-            except InvalidArgument as err:
-                return await self.do_help(task, error_str=str(err), cmd=task.command.name)
-            await fn(task)
+            return
+        try:
+            if info.num_args is not None and info.num_args != len(task.args):
+                raise InvalidArgument("Your arguments are invalid")
+        except InvalidArgument as err:
+            return await self.do_help(task, error_str=str(err), cmd=task.command.name)
+        await info.handler(task)
 
     @helpstr("Show the title of the currently playing song", num_args=0)
     async def do_now_playing(self, task: TaskState):
@@ -239,70 +610,83 @@ class CommandDispatcher(asyncio.Queue):
             await client.join_voice_channel(channel)
 
     @staticmethod
+    @internal
+    @task_timeout(None)
+    @task_priority(TaskPriority.background)
     async def do_server_connect(task: TaskState):
         from roboto.disc import dc
-        session = Session()
-        server_info = Server.get(session, task.server_id, create=True)
         try:
+            voice_channel_id = await database.run_in_session(Server.get_voice_channel_id, task.server_id)
             server = await task.server()
             await asyncio.sleep(1)
             dsc_server = dc.get_server(task.server_id)
             await asyncio.sleep(1)
             for channel in dsc_server.channels:
-                if channel.type == ChannelType.voice and channel.id == server_info.voice_channel_id:
+                if channel.type == ChannelType.voice and channel.id == voice_channel_id:
                     vc = await dc.join_voice_channel(channel)
-                    if channel.id != server_info.voice_channel_id:
-                        server_info.voice_channel_id = channel.id
-                    server.set_voice_channel(channel.id)
+                    server.set_voice_channel(channel.id, stored=True)
                     server.voice_client = vc
-            server.markov_model.rebuild_chain(session)
-            session.commit()
         except DBAPIError:
             log.exception("Exception during server connect event")
-            session.rollback()
         except AttributeError:
             pass
 
     @helpstr("Generate a random sentence")
     async def do_talk(self, task: TaskState):
         server = await task.server()
+        try:
+            model = await server.get_markov_model()
+        except DBAPIError:
+            log.exception("Failed to load markov chain")
+            return await self.send_message(task, "Failed to generate message")
         if len(task.args) >= 1:
-            t = server.markov_model.make_sentence_with_start(" ".join(task.args))
+            t = await model.make_sentence_with_start_async(" ".join(task.args))
         else:
-            t = server.markov_model.make_sentence(tries=20)
+            t = await model.make_sentence_async(tries=20)
         if not t:
             t = "Failed to generate message"
         return await self.send_message(task, t)
 
     @staticmethod
+    @task_priority(TaskPriority.background)
     async def do_record(task: TaskState) -> bool:
+        """ Queue the message with the write-behind recorder, it will be stored and folded into the
+        markov chain with the next batch.
+        """
         if not task.args:
             return False
-        session = Session()
+        await recorder.add(task.source, task.get_user_id(), task.server_id, task.channel, task.args[0])
+        return True
+
+    @staticmethod
+    @admin
+    @helpstr("Rebuild the markov chain from the recorded messages, admins only", num_args=0)
+    @task_timeout(None)
+    @task_priority(TaskPriority.background)
+    @coalescible()
+    async def do_rebuild_markov(task: TaskState):
+        """ Force a full rebuild of the servers markov chain. Recorded messages are already folded into
+        the chain incrementally so this is only needed on demand, eg: after messages were removed.
+        """
+        server = await task.server()
         try:
-            UserMessage.record(session, task.get_user(session), task.source,
-                               task.server_id, task.channel, task.args[0])
-            session.commit()
+            await server.markov_model.rebuild_chain_async()
         except DBAPIError:
-            session.rollback()
-            log.exception("Failed to add new message")
-            return False
-        else:
-            log.debug("Recorded message")
-            return True
+            log.exception("Failed to rebuild markov chain")
 
     @staticmethod
     async def send_message(task: TaskState, message: str) -> bool:
+        """ Queue a reply with the rate limited outbound sender of the tasks channel
+
+        :return: False if the message was empty or dropped
+        """
         if not message:
             return False
         if task.source == TaskSource.discord:
-            disc = task.get_client_discord()
-            channel = disc.get_channel(task.channel)
-            await disc.send_message(channel, message)
+            return outbox.send(task.source, task.get_client_discord(), task.channel, message)
         elif task.source == TaskSource.twitch:
-            await task.get_client_twitch().privmsg(task.channel, message)
-        else:
-            log.debug(message)
+            return outbox.send(task.source, task.get_client_twitch(), task.channel, message)
+        log.debug(message)
         return True
 
     @helpstr("Return info about a overwatch bnet id, uses configured default if none supplied")
@@ -323,7 +707,7 @@ class CommandDispatcher(asyncio.Queue):
     @helpstr("Stop the current song/audio stream")
     async def do_stop(self, task: TaskState):
         server = await state.servers.get_server(task.server_id)
-        media.music_stop(server)
+        await media.music_stop(server)
 
     @helpstr("Show the playlist link")
     async def do_playlist(self, task: TaskState):
@@ -332,11 +716,49 @@ class CommandDispatcher(asyncio.Queue):
     @helpstr("Play a specific song by id", num_args=1)
     async def do_play(self, task: TaskState):
         server_state = await state.servers.get_server(task.server_id)
-        if media.play_file(server_state, task.args[0]):
+        if await media.play_file(server_state, task.args[0]):
             await media.send_now_playing(task.server_id, task.channel)
         else:
             await self.send_message(task, "Failed to play song, invalid id?")
 
+    @helpstr("Queue songs by id or media URL, shows the queue when nothing is given")
+    async def do_queue(self, task: TaskState):
+        server_state = await state.servers.get_server(task.server_id)
+        if not task.args:
+            songs = list(islice(server_state.queue, 10))
+            if not songs:
+                return await self.send_message(task, "Queue is empty")
+            msg = " | ".join("[#{}] {}".format(pos, media.item_title(item)) for pos, item in enumerate(songs, 1))
+            if len(server_state.queue) > len(songs):
+                msg = "{} (+{} more)".format(msg, len(server_state.queue) - len(songs))
+            return await self.send_message(task, msg)
+        for item in task.args:
+            position = await media.enqueue(server_state, item)
+            if position is None:
+                await self.send_message(task, "Failed to queue {}, invalid id or queue full".format(item))
+            elif position == 0:
+                await media.send_now_playing(task.server_id, task.channel)
+            elif position == media.NOT_PLAYED:
+                await self.send_message(task, "Failed to play {}, it stays queued".format(media.item_title(item)))
+            else:
+                await self.send_message(task, "Queued {} at #{}".format(media.item_title(item), position))
+
+    @helpstr("Shuffle the queued songs", num_args=0)
+    async def do_shuffle(self, task: TaskState):
+        server_state = await state.servers.get_server(task.server_id)
+        await server_state.media.shuffle()
+        await self.send_message(task, "Shuffled {} queued songs".format(len(server_state.queue)))
+
+    @helpstr("Search the music library by artist, album or title")
+    async def do_search(self, task: TaskState):
+        if not task.args:
+            return await self.send_message(task, "Must supply something to search for")
+        # Fuzzy matching a large library takes a while, keep it off the event loop
+        results = await self._loop.run_in_executor(None, media.search_songs, " ".join(task.args))
+        if not results:
+            return await self.send_message(task, "No songs found")
+        return await self.send_message(task, " | ".join("[#{}] {}".format(f.song_id, f.path) for f in results))
+
     @helpstr("0-200 Change the volume of the audio stream", num_args=1)
     async def do_vol(self, task: TaskState):
         server = await state.servers.get_server(task.server_id)
@@ -365,11 +787,11 @@ class CommandDispatcher(asyncio.Queue):
             msg = "{} [ERR: {}]".format(msg, error_str)
         await self.send_message(task, msg)
 
-    @helpstr("Play the next song in the playlist/albun")
+    @helpstr("Play the next song in the queue or playlist/album")
     async def do_next(self, task: TaskState):
         server_state = await state.servers.get_server(task.server_id)
-        if media.play_next(server_state):
-            await media.send_now_playing(task.server_id, task.channel)
+        # The player is started in the background once no newer !next arrived within the debounce period
+        media.skip(server_state, task.channel)
 
     @helpstr("Play a youtube stream")
     async def do_yt(self, task: TaskState) -> bool:
@@ -388,5 +810,8 @@ class CommandDispatcher(asyncio.Queue):
 
 dispatcher = CommandDispatcher(loop)
 
+registry = CommandRegistry()
+registry.load(dispatcher)
+
 # cyclic fix
 from roboto import state
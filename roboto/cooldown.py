@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from logging import getLogger
+from roboto import config, loop
+
+log = getLogger(__name__)
+
+
+class WindowCounter(object):
+    """
+    Approximate sliding window count using the counts of the current and the previous fixed window,
+    the previous one weighted by how much of it still overlaps the sliding window.
+    """
+    __slots__ = ("start", "current", "previous")
+
+    def __init__(self, now):
+        self.start = now
+        self.current = 0
+        self.previous = 0
+
+    def _advance(self, now, window):
+        elapsed = now - self.start
+        if elapsed < window:
+            return
+        self.previous = self.current if elapsed < window * 2 else 0
+        self.current = 0
+        self.start += window * (elapsed // window)
+
+    def count(self, now, window) -> float:
+        self._advance(now, window)
+        return self.previous * (window - (now - self.start)) / window + self.current
+
+    def add(self, now, window):
+        self._advance(now, window)
+        self.current += 1
+
+
+class Cooldowns(object):
+    """
+    Flood control for chat commands, applied before they're queued with the dispatcher. A command is
+    dropped when any of its windows is full:
+
+    - user: commands by a user in a channel
+    - command: uses of a command in a channel, the limit can be set per command
+    - channel: commands in a channel
+
+    The same command with the same arguments repeated in a channel within duplicate_window seconds is
+    dropped as it's already being handled. The counters and the last seen times of requests are kept in
+    a LRU table of at most max_keys entries. A limit of 0 disables the window.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self.user = (5, 10.0)
+        self.command = (3, 10.0)
+        self.channel = (20, 10.0)
+        self.command_limits = dict()
+        self.duplicate_window = 3.0
+        # Plain chat messages being recorded, everything else typed in chat counts against the windows.
+        # Internal tasks are queued by the bot itself and never pass through here.
+        self.exempt = {"record"}
+        self._counters = OrderedDict()
+        self.allowed = 0
+        self.limited = 0
+        self.duplicates = 0
+
+    def configure(self):
+        self.max_keys = int(config.get("cooldown_max_keys", self.max_keys))
+        self.user = (int(config.get("cooldown_user_limit", self.user[0])),
+                     float(config.get("cooldown_user_window", self.user[1])))
+        self.command = (int(config.get("cooldown_command_limit", self.command[0])),
+                        float(config.get("cooldown_command_window", self.command[1])))
+        self.channel = (int(config.get("cooldown_channel_limit", self.channel[0])),
+                        float(config.get("cooldown_channel_window", self.channel[1])))
+        self.duplicate_window = float(config.get("cooldown_duplicate_window", self.duplicate_window))
+        self.command_limits = dict()
+        for key, value in config.items():
+            name, _, command = key.partition(".")
+            if name == "cooldown_command_limit" and command:
+                self.command_limits[command.lower()] = int(value)
+
+    def _put(self, key, value):
+        self._counters[key] = value
+        self._counters.move_to_end(key)
+        if len(self._counters) > self.max_keys:
+            self._counters.popitem(last=False)
+
+    def _counter(self, key, now) -> WindowCounter:
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = WindowCounter(now)
+        self._put(key, counter)
+        return counter
+
+    def _windows(self, task):
+        """ The (key, limit, window) of every window the task counts against """
+        channel = (task.source, task.channel)
+        name = task.command.name
+        yield ("user",) + channel + (task.get_user_id(),), self.user[0], self.user[1]
+        yield ("command",) + channel + (name,), self.command_limits.get(name, self.command[0]), self.command[1]
+        yield ("channel",) + channel, self.channel[0], self.channel[1]
+
+    def allow(self, task, now=None) -> bool:
+        """ Check the task against its windows, counting it if it's allowed
+
+        :param task: TaskState about to be queued
+        :param now: Defaults to the loop time
+        :return: False if the task should be dropped
+        """
+        if task.command.name in self.exempt:
+            return True
+        if now is None:
+            now = loop.time()
+        duplicate_key = ("duplicate", task.source, task.channel, task.command.name, tuple(task.args))
+        if self.duplicate_window > 0:
+            last_seen = self._counters.get(duplicate_key)
+            if last_seen is not None and now - last_seen < self.duplicate_window:
+                self.duplicates += 1
+                log.debug("Dropped duplicate task: {}".format(task))
+                return False
+        windows = [(self._counter(key, now), limit, window) for key, limit, window in self._windows(task)
+                   if limit > 0]
+        if any(counter.count(now, window) >= limit for counter, limit, window in windows):
+            self.limited += 1
+            log.debug("Rate limited task: {}".format(task))
+            return False
+        for counter, _, window in windows:
+            counter.add(now, window)
+        if self.duplicate_window > 0:
+            self._put(duplicate_key, now)
+        self.allowed += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._counters),
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "duplicates": self.duplicates
+        }
+
+
+cooldowns = Cooldowns()
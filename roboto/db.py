@@ -0,0 +1,157 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from sqlalchemy import event
+from roboto import config, loop
+from roboto.model import Session
+
+log = getLogger(__name__)
+
+
+class Timing(object):
+    """
+    Running count, total and max of a duration in seconds
+    """
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max
+        }
+
+
+class Database(object):
+    """
+    Awaitable access to the database. The blocking SQLAlchemy work runs in a dedicated thread pool so
+    a slow round trip never stalls the event loop, each call uses its own session.
+
+    Calls and the statements they execute are timed, statements slower than slow_query seconds are
+    logged.
+    """
+
+    def __init__(self, workers=4, slow_query=0.5):
+        self.workers = workers
+        self.slow_query = slow_query
+        self._executor = None
+        self._engine = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.errors = 0
+        self.calls = Timing()
+        self.statements = Timing()
+
+    def configure(self):
+        """ Apply the config values and instrument the engine, must be called after init_db """
+        self.workers = int(config.get("db_workers", self.workers))
+        self.slow_query = float(config.get("db_slow_query", self.slow_query))
+        engine = Session.kw.get("bind")
+        if engine is not None and engine is not self._engine:
+            event.listen(engine, "before_cursor_execute", self._before_execute)
+            event.listen(engine, "after_cursor_execute", self._after_execute)
+            self._engine = engine
+
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def run(self, fn, *args):
+        """ Run a blocking function in the database thread pool
+
+        :param fn: Callable doing blocking database work
+        :return: Result of fn
+        """
+        with self._lock:
+            self.in_flight += 1
+        return await loop.run_in_executor(self.executor(), self._call, fn, args)
+
+    async def run_in_session(self, fn, *args):
+        """ Run fn(session, *args) in the database thread pool with a new session. The session is
+        committed when fn returns and rolled back when it raises. Results must not be ORM objects,
+        they are expired once the session is closed.
+
+        :param fn: Callable taking a session as its first argument
+        :return: Result of fn
+        """
+        return await self.run(self._in_session, fn, *args)
+
+    @staticmethod
+    def _in_session(fn, *args):
+        session = Session()
+        try:
+            result = fn(session, *args)
+            session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _call(self, fn, args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.calls.add(time.perf_counter() - start)
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        with self._lock:
+            self.statements.add(elapsed)
+        if elapsed >= self.slow_query:
+            log.warning("Slow query ({:.3f}s): {}".format(elapsed, " ".join(statement.split())[:200]))
+
+    def pool_stats(self) -> dict:
+        """ Connection pool usage, only the counts the pool implementation supports are included """
+        if self._engine is None:
+            return {}
+        pool = self._engine.pool
+        stats = {"status": pool.status()}
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            fn = getattr(pool, name, None)
+            if fn is not None:
+                stats[name] = fn()
+        return stats
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "errors": self.errors,
+            "calls": self.calls.stats(),
+            "statements": self.statements.stats(),
+            "pool": self.pool_stats()
+        }
+
+
+database = Database()
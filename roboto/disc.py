@@ -1,10 +1,9 @@
 from logging import getLogger
 import discord
-from sqlalchemy.exc import DBAPIError
 
 from roboto import commands, state
 from roboto import loop
-from roboto.model import Session, Server
+from roboto.cooldown import cooldowns
 
 dc = discord.Client(loop=loop)
 log = getLogger("discord")
@@ -12,18 +11,15 @@ log = getLogger("discord")
 
 @dc.async_event
 async def on_voice_state_update(before, after):
-    session = Session()
-    try:
-        if after.voice_channel:
-            voice_channel_id = after.voice_channel.id
-        else:
-            voice_channel_id = None
-        server = Server.get(session, after.server.id)
-        server.voice_channel_id = voice_channel_id
-        session.commit()
-    except DBAPIError:
-        log.exception("Failed to update voice state")
-        session.rollback()
+    # Only the channel of the bot itself is restored on connect, mutes and other members are ignored
+    if after.id != dc.user.id:
+        return
+    if after.voice_channel:
+        voice_channel_id = after.voice_channel.id
+    else:
+        voice_channel_id = None
+    server = await state.servers.get_server(after.server.id)
+    server.set_voice_channel(voice_channel_id)
 
 
 @dc.async_event
@@ -40,13 +36,15 @@ async def on_message(message):
         task.set_channel(message.channel.id)
         task.set_user(message.author.id)
         task.set_server_id(message.server.id)
+        if not cooldowns.allow(task):
+            return
         await commands.dispatcher.add_task(task)
 
 
 @dc.event
 async def on_ready():
     log.info("logged in: {}/{}".format(dc.user.name, dc.user.id))
-    for channel in dc.get_all_channels():
-        await state.servers.get_server(channel.server.id)
+    for server in list(dc.servers):
+        await state.servers.get_server(server.id)
 
 
@@ -8,3 +8,7 @@ class ValidationError(RobotoException):
 
 class InvalidArgument(ValidationError):
     pass
+
+
+class ExtractError(RobotoException):
+    pass
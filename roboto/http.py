@@ -1,39 +1,271 @@
 import asyncio
-from urllib.parse import unquote_plus
+import json
+from collections import OrderedDict
+from math import ceil
+from urllib.parse import unquote_plus, urlencode
 from os.path import join, abspath, dirname
 import aiohttp_jinja2
 import jinja2
 from aiohttp import web
 from roboto import disc, media, config, loop, state
+from roboto.library import get_library
 
 web_app = web.Application(loop=loop)
 
+# Values of the group query param that enable grouping the playlist by directory
+GROUP_VALUES = {"1", "true", "dir", "album"}
+
+
+class PlaylistView(object):
+    """
+    The slice of the playlist requested by a client
+    """
+
+    def __init__(self, query=None, page=1, per_page=500, group=False, fmt="html"):
+        self.query = query
+        self.page = page
+        self.per_page = per_page
+        self.group = group
+        self.fmt = fmt
+
+    @classmethod
+    def from_request(cls, request, default_size=500, max_size=5000):
+        """ Build the view from the query string. per_page=0 requests the whole playlist in one page.
+
+        :param request:
+        :param default_size: per_page used when not provided
+        :param max_size: Largest per_page allowed, other than 0
+        :rtype: PlaylistView
+        """
+        args = request.query
+        try:
+            page = max(1, int(args.get("page", 1)))
+        except ValueError:
+            page = 1
+        try:
+            per_page = int(args.get("per_page", default_size))
+        except ValueError:
+            per_page = default_size
+        per_page = min(max(per_page, 0), max_size)
+        fmt = args.get("format")
+        if fmt not in ("html", "json"):
+            accept = request.headers.get("Accept", "")
+            fmt = "json" if "application/json" in accept and "text/html" not in accept else "html"
+        return cls(args.get("q") or None, page, per_page, args.get("group", "").lower() in GROUP_VALUES, fmt)
+
+    def key(self):
+        return self.query, self.page, self.per_page, self.group, self.fmt
+
+    def url(self, server_id, page):
+        args = [("page", page)]
+        if self.query:
+            args.append(("q", self.query))
+        if self.group:
+            args.append(("group", "dir"))
+        args.append(("per_page", self.per_page))
+        return "/{}?{}".format(server_id, urlencode(args))
+
+
+class PlaylistPage(object):
+    """
+    A page of the playlist, rendered in chunks of chunk_size entries. The chunks are rendered in a
+    worker thread on first use and can then be reused by later requests for the same page.
+    """
+
+    def __init__(self, server_id, view: PlaylistView, entries, chunk_size=500):
+        self.server_id = server_id
+        self.view = view
+        self.entries = entries
+        self.total = len(entries)
+        if view.per_page:
+            self.start = min((view.page - 1) * view.per_page, self.total)
+            self.end = min(self.start + view.per_page, self.total)
+        else:
+            self.start, self.end = 0, self.total
+        self.chunk_size = chunk_size
+        # Whether rendered chunks are kept, disabled for pages too large to cache
+        self.keep = True
+        self._chunks = []
+
+    @property
+    def pages(self):
+        if not self.view.per_page:
+            return 1
+        return max(1, int(ceil(self.total / self.view.per_page)))
+
+    def __len__(self):
+        """ Number of chunks """
+        return int(ceil((self.end - self.start) / self.chunk_size))
+
+    async def chunk(self, idx) -> str:
+        """ Rendered chunk idx of the page
+
+        :param idx:
+        """
+        if idx < len(self._chunks):
+            return self._chunks[idx]
+        rendered = await loop.run_in_executor(None, self.render, idx)
+        if self.keep and idx == len(self._chunks):
+            self._chunks.append(rendered)
+        return rendered
+
+    def render(self, idx) -> str:
+        start = self.start + idx * self.chunk_size
+        end = min(start + self.chunk_size, self.end)
+        items = self.entries[start:end]
+        if self.view.fmt == "json":
+            body = ",".join(json.dumps({
+                "song_id": item.song_id,
+                "path": item.path,
+                "dir": item.dir,
+                "name": item.name()
+            }) for item in items)
+            return "," + body if idx else body
+        rows = []
+        prev_dir = self.entries[start - 1].dir if start else None
+        for item in items:
+            item_dir = item.dir
+            header = item_dir if self.view.group and item_dir != prev_dir else None
+            prev_dir = item_dir
+            rows.append((header, item.song_id, item.path))
+        return get_template("playlist_entries.html").render(server_id=self.server_id, rows=rows)
+
+
+class PlaylistPages(object):
+    """
+    LRU of rendered playlist pages. Pages are keyed by the library version so a rescan that changes
+    the library simply stops matching the old entries. Pages larger than max_page_size are rendered
+    chunk by chunk while streaming and never kept.
+    """
+
+    def __init__(self, max_size=64, page_size=500, max_page_size=5000, search_limit=200):
+        self.max_size = max_size
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.search_limit = search_limit
+        self._pages = OrderedDict()
+
+    def configure(self):
+        self.max_size = int(config.get("http_page_cache_size", self.max_size))
+        self.page_size = int(config.get("http_page_size", self.page_size))
+        self.max_page_size = int(config.get("http_max_page_size", self.max_page_size))
+        self.search_limit = int(config.get("http_search_limit", self.search_limit))
+
+    def view(self, request) -> PlaylistView:
+        return PlaylistView.from_request(request, self.page_size, self.max_page_size)
+
+    async def get(self, server_id, view: PlaylistView) -> PlaylistPage:
+        library = get_library()
+        key = (library.version, server_id) + view.key()
+        page = self._pages.get(key)
+        if page is not None:
+            self._pages.move_to_end(key)
+            return page
+        if view.query:
+            entries = await loop.run_in_executor(None, media.search_songs, view.query, self.search_limit)
+        else:
+            entries = library.files()
+        page = PlaylistPage(server_id, view, entries)
+        page.keep = page.end - page.start <= self.max_page_size
+        if page.keep:
+            self._pages[key] = page
+            while len(self._pages) > self.max_size:
+                self._pages.popitem(last=False)
+        return page
+
+    def clear(self):
+        self._pages.clear()
+
+
+pages = PlaylistPages()
+
+
+def get_template(name) -> jinja2.Template:
+    return aiohttp_jinja2.get_env(web_app).get_template(name)
+
+
+def etag_matches(request, etag) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    tags = {tag.strip() for tag in header.split(",")}
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+
+def not_modified(request, etag, last_modified) -> bool:
+    """ Evaluate the conditional request headers, If-None-Match takes precedence over If-Modified-Since """
+    if "If-None-Match" in request.headers:
+        return etag_matches(request, etag)
+    since = request.if_modified_since
+    return since is not None and int(last_modified) <= since.timestamp()
+
 
-@aiohttp_jinja2.template('index.html')
 async def handle_index(request):
     server_id = request.match_info['server_id']
     server_state = await state.servers.get_server(server_id)
-    return {
-        "entries": media.fetch_media_files(config.get("music_path")),
-        "now_playing": None,
-        "current_song_id": server_state.song_id,
-        "server_id": server_id
-    }
+    library = get_library()
+    view = pages.view(request)
+    etag = '"{:x}.{:x}-{}-{}"'.format(
+        library.version, int(library.updated_on), server_state.song_id, view.fmt)
+    last_modified = max(library.updated_on, server_state.song_changed_on)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+    if not_modified(request, etag, last_modified):
+        resp = web.Response(status=304, headers=headers)
+        resp.last_modified = last_modified
+        return resp
+    page = await pages.get(server_id, view)
+    resp = web.StreamResponse(headers=headers)
+    resp.last_modified = last_modified
+    resp.enable_chunked_encoding()
+    if view.fmt == "json":
+        resp.content_type = "application/json"
+        head = json.dumps({
+            "server_id": server_id,
+            "query": view.query,
+            "page": view.page,
+            "per_page": view.per_page,
+            "pages": page.pages,
+            "total": page.total,
+            "current_song_id": server_state.song_id
+        })[:-1] + ', "entries": ['
+        foot = "]}"
+    else:
+        resp.content_type = "text/html"
+        ctx = {
+            "query": view.query,
+            "group": view.group,
+            "page": page,
+            "prev_url": view.url(server_id, view.page - 1) if view.page > 1 else None,
+            "next_url": view.url(server_id, view.page + 1) if view.page < page.pages else None,
+            "current_song_id": server_state.song_id,
+            "server_id": server_id
+        }
+        head = get_template("playlist_head.html").render(**ctx)
+        foot = get_template("playlist_foot.html").render(**ctx)
+    await resp.prepare(request)
+    await resp.write(head.encode("utf-8"))
+    for idx in range(len(page)):
+        await resp.write((await page.chunk(idx)).encode("utf-8"))
+    await resp.write(foot.encode("utf-8"))
+    await resp.write_eof()
+    return resp
 
 
 @aiohttp_jinja2.template('play.html')
 async def handle_play(request):
-    full_path = None
     server_id = request.match_info['server_id']
     server = disc.dc.get_server(server_id)
     if not server:
         raise ValueError("Invalid server_id")
     song_id = unquote_plus(request.match_info['song_id'])
     server_state = await state.servers.get_server(server_id)
-    if media.play_file(server_state, song_id):
+    position = await media.enqueue(server_state, song_id)
+    if position == 0:
         await media.send_now_playing(server_id)
     return {
-        "file_name": full_path,
+        "file_name": media.find_song_path(song_id),
+        "position": position,
+        "not_played": position == media.NOT_PLAYED,
         "current_song_id": song_id,
         "server_id": request.match_info['server_id']
     }
@@ -43,6 +275,7 @@ def setup():
     # Configure & load HTTP Interface
     template_path = join(abspath(dirname(__file__)), 'templates')
     aiohttp_jinja2.setup(web_app, loader=jinja2.FileSystemLoader(template_path))
+    pages.configure()
     web_app.router.add_get("/{server_id}", handle_index)
     web_app.router.add_get("/{server_id}/play/{song_id}", handle_play)
     http_server = loop.create_server(
@@ -1,5 +1,6 @@
 import irc3
-from roboto import commands
+from roboto import commands, config, loop
+from roboto.cooldown import cooldowns
 
 
 @irc3.plugin
@@ -13,7 +14,9 @@ class TwitchClient(object):
             self.ignored = bot.config.ignored_users
         except AttributeError:
             self.ignored = []
+        # Loop time of the last command accepted, commands closer together than cmd_interval are dropped
         self.last_cmd_time = 0
+        self.cmd_interval = float(config.get("cooldown_twitch_interval", 0))
 
     @irc3.event(irc3.rfc.PRIVMSG)
     async def parse_input(self, mask, target, data, event):
@@ -26,9 +29,24 @@ class TwitchClient(object):
             task.set_channel(target)
             task.set_server_id(target)
             task.set_user(mask.nick)
+            if not self.accept(task):
+                return
             await commands.dispatcher.add_task(task)
         else:
+            # Recorded messages are folded into the markov chain incrementally, no rebuild required
             self.input_lines += 1
-            if self.input_lines % 1 == 0:
-                await commands.dispatcher.add_task(
-                    commands.TaskState(commands.Commands.rebuild_markov, []))
+
+    def accept(self, task: commands.TaskState) -> bool:
+        """ Apply the flood control before the task is queued
+
+        :return: False if the task should be dropped
+        """
+        if task.command.name in cooldowns.exempt:
+            return True
+        now = loop.time()
+        if now - self.last_cmd_time < self.cmd_interval:
+            return False
+        if not cooldowns.allow(task, now):
+            return False
+        self.last_cmd_time = now
+        return True
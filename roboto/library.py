@@ -0,0 +1,523 @@
+import asyncio
+import heapq
+import os
+import pickle
+import re
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from logging import getLogger
+from os.path import sep, splitext, join, exists
+from urllib.parse import quote_plus
+from roboto import config, loop
+
+log = getLogger(__name__)
+
+valid_music_ext = {'.flac', '.mp3'}
+
+# Bump whenever the on disk index layout changes, older indexes are then rebuilt from scratch
+INDEX_VERSION = 2
+
+
+def is_media_file(path):
+    try:
+        return splitext(path)[1].lower() in valid_music_ext
+    except IndexError:
+        return False
+
+
+class MediaFile(object):
+    """
+    Lightweight view of a single entry of a MediaCatalog
+    """
+    __slots__ = ("_catalog", "_pos")
+
+    def __init__(self, catalog, pos):
+        self._catalog = catalog
+        self._pos = pos
+
+    @property
+    def path(self):
+        return self._catalog.path(self._pos)
+
+    @property
+    def song_id(self):
+        return self._catalog.song_id(self._pos)
+
+    @property
+    def dir(self):
+        return self._catalog.dir(self._pos)
+
+    def name(self):
+        return self._catalog.name(self._pos)
+
+    @property
+    def is_dir(self):
+        return self._catalog.in_subdir(self._pos)
+
+    @property
+    def safe_path(self):
+        return self._catalog.safe_path(self._pos)
+
+
+class MediaCatalog(object):
+    """
+    Array backed, read only list of media files sorted by path. Directory prefixes are interned
+    and stored once, file names are packed into a single string addressed through an offsets array.
+    Entries are served as MediaFile views created on access.
+    """
+
+    def __init__(self, entries=()):
+        """
+
+        :param entries: iterable of (relative dir, file name, song_id) sorted by path
+        """
+        dirs = []
+        dir_lookup = dict()
+        names = []
+        total = 0
+        self._dir_idx = array("I")
+        self._offsets = array("I", [0])
+        self._song_ids = array("I")
+        for rel_dir, name, song_id in entries:
+            try:
+                d = dir_lookup[rel_dir]
+            except KeyError:
+                d = dir_lookup[rel_dir] = len(dirs)
+                dirs.append(sys.intern(rel_dir))
+            self._dir_idx.append(d)
+            names.append(name)
+            total += len(name)
+            self._offsets.append(total)
+            self._song_ids.append(song_id)
+        self._names = "".join(names)
+        self._dirs = dirs
+        self._dir_prefixes = [d + sep if d else "" for d in dirs]
+        self._quoted_dirs = [quote_plus(d) for d in self._dir_prefixes]
+        # song_id -> position, -1 for ids that are no longer present
+        self._positions = array("i", [-1]) * (max(self._song_ids) + 1 if self._song_ids else 0)
+        for pos, song_id in enumerate(self._song_ids):
+            self._positions[song_id] = pos
+
+    def __len__(self):
+        return len(self._song_ids)
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [MediaFile(self, i) for i in range(*pos.indices(len(self)))]
+        if pos < 0:
+            pos += len(self)
+        if not 0 <= pos < len(self):
+            raise IndexError("catalog index out of range")
+        return MediaFile(self, pos)
+
+    def __iter__(self):
+        for pos in range(len(self)):
+            yield MediaFile(self, pos)
+
+    def name(self, pos):
+        return self._names[self._offsets[pos]:self._offsets[pos + 1]]
+
+    def path(self, pos):
+        return self._dir_prefixes[self._dir_idx[pos]] + self.name(pos)
+
+    def safe_path(self, pos):
+        return self._quoted_dirs[self._dir_idx[pos]] + quote_plus(self.name(pos))
+
+    def dir(self, pos):
+        return self._dirs[self._dir_idx[pos]]
+
+    def dir_index(self, pos):
+        return self._dir_idx[pos]
+
+    def in_subdir(self, pos):
+        return bool(self._dirs[self._dir_idx[pos]])
+
+    def song_id(self, pos):
+        return self._song_ids[pos]
+
+    def position(self, song_id):
+        """ Position of the song in path order or None if it isn't in the catalog """
+        try:
+            if song_id < 0:
+                return None
+            pos = self._positions[song_id]
+        except (IndexError, TypeError):
+            return None
+        return pos if pos >= 0 else None
+
+
+_token_re = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _token_re.findall(text.lower())
+
+
+def within_distance(a, b, max_dist) -> bool:
+    """ Bounded Levenshtein distance check, stops as soon as every path exceeds max_dist """
+    if abs(len(a) - len(b)) > max_dist:
+        return False
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > max_dist:
+            return False
+        prev = cur
+    return prev[-1] <= max_dist
+
+
+class SearchIndex(object):
+    """
+    Inverted index over the tokenized path components (artist/album directories and the title)
+    of a MediaCatalog. Terms match exactly, as a prefix of a token or, when neither matches, within
+    a small edit distance of a token starting with the same character.
+    """
+    exact_weight = 3
+    prefix_weight = 2
+    fuzzy_weight = 1
+
+    def __init__(self, catalog: MediaCatalog, max_expansions=200):
+        self.max_expansions = max_expansions
+        postings = dict()
+        dir_tokens = dict()
+        for pos in range(len(catalog)):
+            d = catalog.dir_index(pos)
+            try:
+                tokens = dir_tokens[d]
+            except KeyError:
+                tokens = dir_tokens[d] = frozenset(tokenize(catalog.dir(pos)))
+            for token in tokens.union(tokenize(splitext(catalog.name(pos))[0])):
+                try:
+                    postings[token].append(pos)
+                except KeyError:
+                    postings[token] = [pos]
+        self._postings = {token: array("I", positions) for token, positions in postings.items()}
+        self._vocab = sorted(self._postings)
+        # (first char, length) -> tokens, candidates for fuzzy matching
+        self._buckets = dict()
+        for token in self._vocab:
+            self._buckets.setdefault((token[0], len(token)), []).append(token)
+
+    def _expand(self, term):
+        """ Find the tokens matching a single query term
+
+        :return: [(token, weight)]
+        """
+        expansions = []
+        if term in self._postings:
+            expansions.append((term, self.exact_weight))
+        i = bisect_left(self._vocab, term)
+        for token in self._vocab[i:i + self.max_expansions]:
+            if not token.startswith(term):
+                break
+            if token != term:
+                expansions.append((token, self.prefix_weight))
+        if expansions or len(term) < 3:
+            return expansions
+        max_dist = 1 if len(term) < 7 else 2
+        for length in range(len(term) - max_dist, len(term) + max_dist + 1):
+            for token in self._buckets.get((term[0], length), ()):
+                if within_distance(term, token, max_dist):
+                    expansions.append((token, self.fuzzy_weight))
+        return expansions
+
+    def _size(self, expansions):
+        return sum(len(self._postings[token]) for token, _ in expansions)
+
+    def _weights(self, expansions) -> dict:
+        """
+
+        :return: dict of catalog position -> weight of the best matching token
+        """
+        weights = dict()
+        for token, weight in expansions:
+            for pos in self._postings[token]:
+                if weights.get(pos, 0) < weight:
+                    weights[pos] = weight
+        return weights
+
+    def _contains(self, token, pos) -> bool:
+        positions = self._postings[token]
+        i = bisect_left(positions, pos)
+        return i < len(positions) and positions[i] == pos
+
+    def search(self, query, limit=10):
+        """ Find the catalog positions matching every term of the query, best matches first. Terms are
+        applied rarest first, once few candidates remain they are checked against the posting lists
+        directly instead of materializing every match of the remaining terms.
+
+        :param query:
+        :param limit: Max number of results
+        :return: []int
+        """
+        terms = [self._expand(term) for term in tokenize(query)]
+        if not terms or not all(terms):
+            return []
+        terms.sort(key=self._size)
+        scores = self._weights(terms[0])
+        for expansions in terms[1:]:
+            if len(scores) * len(expansions) < self._size(expansions):
+                narrowed = dict()
+                for pos, score in scores.items():
+                    best = 0
+                    for token, weight in expansions:
+                        if weight > best and self._contains(token, pos):
+                            best = weight
+                    if best:
+                        narrowed[pos] = score + best
+                scores = narrowed
+            else:
+                matches = self._weights(expansions)
+                scores = {pos: score + matches[pos] for pos, score in scores.items() if pos in matches}
+            if not scores:
+                return []
+        return [pos for pos, _ in heapq.nsmallest(limit, scores.items(), key=lambda kv: (-kv[1], kv[0]))]
+
+
+class ScanResult(object):
+    """
+    Outcome of a filesystem scan, applied to the index on the event loop
+    """
+
+    def __init__(self, dirs, next_id, added=0, removed=0, listed=0, catalog=None):
+        self.dirs = dirs
+        self.next_id = next_id
+        self.added = added
+        self.removed = removed
+        # Number of directories that had to be listed again
+        self.listed = listed
+        self.catalog = catalog
+        self.search_index = SearchIndex(catalog) if catalog is not None else None
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.removed)
+
+
+def build_catalog(dirs) -> MediaCatalog:
+    entries = []
+    for rel_dir, (_, _, names, song_ids, _, _) in dirs.items():
+        prefix = rel_dir + sep if rel_dir else ""
+        entries.extend((prefix + name, rel_dir, name, song_id) for name, song_id in zip(names, song_ids))
+    entries.sort()
+    return MediaCatalog((rel_dir, name, song_id) for _, rel_dir, name, song_id in entries)
+
+
+class MediaIndex(object):
+    """
+    Index of all media files below the music path. Every directory is stored with its mtime and
+    contents so a rescan only lists directories that changed. Song ids are assigned once and stay
+    stable across rescans, ids of removed files are never reused.
+    """
+
+    def __init__(self, root, index_path=None):
+        self.root = root
+        self.index_path = index_path
+        # relative dir -> (mtime_ns, subdirs, file names, song ids, file mtimes, file sizes)
+        self._dirs = dict()
+        self._next_id = 0
+        self._catalog = MediaCatalog()
+        self._search_index = SearchIndex(self._catalog)
+        self._scanning = False
+        self.version = 0
+        # Wall clock time the catalog was last replaced
+        self.updated_on = 0.0
+
+    def read(self):
+        """ Read the persisted index
+
+        :return: ScanResult or None if no compatible index exists
+        :rtype: ScanResult
+        """
+        if not self.index_path or not exists(self.index_path):
+            return None
+        try:
+            with open(self.index_path, "rb") as fp:
+                version, root, dirs, next_id = pickle.load(fp)
+        except (OSError, ValueError, pickle.UnpicklingError):
+            log.exception("Failed to load media index: {}".format(self.index_path))
+            return None
+        if version != INDEX_VERSION or root != self.root:
+            log.warning("Ignoring incompatible media index: {}".format(self.index_path))
+            return None
+        return ScanResult(dirs, next_id, catalog=build_catalog(dirs))
+
+    def save(self):
+        if not self.index_path:
+            return
+        tmp_path = "{}.tmp".format(self.index_path)
+        with open(tmp_path, "wb") as fp:
+            pickle.dump((INDEX_VERSION, self.root, self._dirs, self._next_id), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+    def _list_dir(self, rel_dir, cached):
+        """ List a single directory, keeping the song ids of files that were already indexed
+
+        :return: (subdirs, names, song ids, mtimes, sizes), new files have a song id of -1
+        """
+        known = dict(zip(cached[2], cached[3])) if cached else {}
+        subdirs = []
+        names = []
+        song_ids = []
+        mtimes = array("q")
+        sizes = array("q")
+        with os.scandir(join(self.root, rel_dir)) as it:
+            for entry in it:
+                if entry.is_dir():
+                    subdirs.append(join(rel_dir, entry.name) if rel_dir else entry.name)
+                elif is_media_file(entry.name):
+                    st = entry.stat()
+                    names.append(entry.name)
+                    song_ids.append(known.get(entry.name, -1))
+                    mtimes.append(st.st_mtime_ns)
+                    sizes.append(st.st_size)
+        return tuple(subdirs), tuple(names), song_ids, mtimes, sizes
+
+    def scan(self) -> ScanResult:
+        """ Walk the music path, only listing directories whose mtime changed since the last scan.
+        This does blocking IO and is meant to be run in a worker thread, the index itself is not
+        modified until the result is applied.
+
+        :rtype: ScanResult
+        """
+        old_dirs = self._dirs
+        dirs = dict()
+        listed = 0
+        new_files = []
+        # (st_dev, st_ino) of the directories walked, symlinked directories are followed but a link
+        # back to a parent or to a directory that was already walked is skipped
+        visited = set()
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                st = os.stat(join(self.root, rel_dir))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in visited:
+                log.warning("Skipped media directory already scanned through another path: {}".format(rel_dir))
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            mtime = st.st_mtime_ns
+            cached = old_dirs.get(rel_dir)
+            if cached and cached[0] == mtime:
+                dirs[rel_dir] = cached
+            else:
+                listed += 1
+                try:
+                    subdirs, names, song_ids, mtimes, sizes = self._list_dir(rel_dir, cached)
+                except OSError:
+                    log.exception("Failed to scan media directory: {}".format(rel_dir))
+                    continue
+                new_files.extend((join(rel_dir, name), rel_dir, i)
+                                 for i, (name, song_id) in enumerate(zip(names, song_ids)) if song_id < 0)
+                dirs[rel_dir] = (mtime, subdirs, names, song_ids, mtimes, sizes)
+            stack.extend(dirs[rel_dir][1])
+
+        # Assign ids to new files in path order
+        next_id = self._next_id
+        for _, rel_dir, i in sorted(new_files):
+            dirs[rel_dir][3][i] = next_id
+            next_id += 1
+        for rel_dir, d in dirs.items():
+            if not isinstance(d[3], array):
+                dirs[rel_dir] = d[:3] + (array("I", d[3]),) + d[4:]
+
+        old_count = sum(len(d[2]) for d in old_dirs.values())
+        new_count = sum(len(d[2]) for d in dirs.values())
+        removed = old_count + len(new_files) - new_count
+        catalog = build_catalog(dirs) if new_files or removed or not self.version else None
+        return ScanResult(dirs, next_id, len(new_files), removed, listed, catalog)
+
+    def _apply(self, result: ScanResult):
+        self._dirs = result.dirs
+        self._next_id = result.next_id
+        if result.catalog is not None:
+            self._catalog = result.catalog
+            self._search_index = result.search_index
+            self.version += 1
+            self.updated_on = time.time()
+
+    async def rescan(self) -> bool:
+        """ Scan the music path in a worker thread and apply the changes
+
+        :return: True if files were added or removed
+        """
+        if self._scanning:
+            return False
+        self._scanning = True
+        try:
+            result = await loop.run_in_executor(None, self.scan)
+        finally:
+            self._scanning = False
+        self._apply(result)
+        if result.changed:
+            log.info("Media index updated, added: {} removed: {}".format(result.added, result.removed))
+        if result.listed:
+            await loop.run_in_executor(None, self.save)
+        return result.changed
+
+    async def run(self, interval=600.0):
+        """ Background coroutine that will keep the index up to date
+
+        :param interval: Seconds between rescans
+        """
+        result = await loop.run_in_executor(None, self.read)
+        if result is not None:
+            self._apply(result)
+        while True:
+            try:
+                await self.rescan()
+            except Exception:
+                log.exception("Error scanning media library")
+            await asyncio.sleep(interval)
+
+    def files(self) -> MediaCatalog:
+        """ All media files sorted by path
+
+        :rtype: MediaCatalog
+        """
+        return self._catalog
+
+    def search(self, query, limit=10):
+        """ Search the library by artist, album and title
+
+        :return: []MediaFile
+        """
+        catalog = self._catalog
+        return [catalog[pos] for pos in self._search_index.search(query, limit)]
+
+    def get_path(self, song_id):
+        pos = self._catalog.position(song_id)
+        if pos is None:
+            return None
+        return self._catalog.path(pos)
+
+    def next_song_id(self, song_id):
+        """ The song following song_id in path order """
+        pos = self._catalog.position(song_id)
+        if pos is None or pos + 1 >= len(self._catalog):
+            return None
+        return self._catalog.song_id(pos + 1)
+
+    def __len__(self):
+        return len(self._catalog)
+
+
+_library = None
+
+
+def get_library() -> MediaIndex:
+    """ The media index for the configured music_path, created on first use. It remains empty until
+    the background scanner started with run has loaded or scanned it.
+
+    :rtype: MediaIndex
+    """
+    global _library
+    if _library is None:
+        _library = MediaIndex(config.get("music_path", ""), config.get("media_index_path"))
+    return _library
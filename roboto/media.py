@@ -1,54 +1,34 @@
-from functools import lru_cache
-from operator import attrgetter
-from os.path import sep, splitext, isdir, exists, join
-from os import listdir
-from urllib.parse import quote_plus
+import asyncio
+import random
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from functools import partial
+from os.path import join
 import ipgetter
 from logging import getLogger
 
 from discord import ChannelType
 
-from roboto import config, disc
+from roboto import config, disc, loop, ytdl
+from roboto.exc import ExtractError
+from roboto.model import TaskSource
+from roboto.outbound import outbox, NOW_PLAYING
+from roboto.library import get_library
+from roboto.text import valid_url
 
 log = getLogger(__name__)
 
-# Continue through the media list via incrementing media_idx
-
-
-media_continuous = True
-
-
-class MediaFile(object):
-    def __init__(self, path, idx=0):
-        self.path = path
-        self.idx = idx
-
-    def name(self):
-        return self.path.split(sep)[-1]
-
-    @property
-    def is_dir(self):
-        pcs = self.path.split(sep)
-        return len(pcs) > 1
-
-    @property
-    def safe_path(self):
-        return quote_plus(self.path)
-
-valid_music_ext = {'.flac', '.mp3'}
-
-
-def is_media_file(path):
-    try:
-        return splitext(path)[1].lower() in valid_music_ext
-    except IndexError:
-        return False
+# Returned by enqueue when the item was queued but playback couldn't be started
+NOT_PLAYED = -1
 
 
 async def send_now_playing(server_id, channel_id=None):
     from roboto.state import servers
     server_state = await servers.get_server(server_id)
-    title = find_song_path(server_state.song_id)
+    title = server_state.media.title
     if not title:
         log.warning("No title for now playing")
         return
@@ -56,100 +36,536 @@ async def send_now_playing(server_id, channel_id=None):
     chan = None
     if channel_id:
         chan = disc.dc.get_channel(channel_id)
-    if chan:
-        await disc.dc.send_message(chan, content=msg)
-    else:
+    if not chan:
         if channel_id:
             log.warning("Failed to find requested channel for NP")
         server = disc.dc.get_server(server_id)
-        for channel in server.channels:
-            if not channel.type == ChannelType.voice:
-                await disc.dc.send_message(channel, content=msg)
-                break
+        chan = next((c for c in server.channels if not c.type == ChannelType.voice), None)
+    if chan:
+        # A newer now playing message replaces this one if it's still queued
+        outbox.send(TaskSource.discord, disc.dc, chan.id, msg, kind=NOW_PLAYING)
 
 
 def find_song_path(song_id, full=False):
-    if not song_id:
+    if song_id is None:
         return None
-    files = fetch_media_files()
     try:
-        path = files[int(song_id)]
-    except IndexError:
+        path = get_library().get_path(int(song_id))
+    except ValueError:
         return None
-    else:
-        if full:
-            return join(config['music_path'], path.path)
-        return path.path
+    if path and full:
+        return join(config['music_path'], path)
+    return path
+
+
+def item_title(item):
+    """ Title of a queue item, the library path of a song or the stream title once it's resolved """
+    if isinstance(item, str):
+        info = ytdl.cache.get(item)
+        return info.title if info is not None and info.title else item
+    return find_song_path(item)
 
 
-@lru_cache(maxsize=None)
-def fetch_media_files(path=None):
-    """ Build a simple list of valid media files. This function assumes you have a shallow dir tree
-    no deeper than 1 folder.
+def search_songs(query, limit=5):
+    """ Find songs by artist, album or title
 
-    :param path:
     :return: []MediaFile
     """
-    if path is None:
+    return get_library().search(query, limit)
+
+
+def fetch_media_files():
+    """ All indexed media files sorted by path, the index is kept up to date by a background scanner
+
+    :return: []MediaFile
+    """
+    return get_library().files()
+
+
+class PlayerState(Enum):
+    idle = 0
+    starting = 1
+    playing = 2
+    stopping = 3
+
+
+_player_executor = None
+
+
+def get_player_executor() -> ThreadPoolExecutor:
+    """ Threads used to start and stop the media players, stopping one can block until ffmpeg exits """
+    global _player_executor
+    if _player_executor is None:
+        _player_executor = ThreadPoolExecutor(max_workers=int(config.get("media_player_workers", 4)))
+    return _player_executor
+
+
+def stop_player(player, timeout=5.0):
+    """ Stop the player and wait for its thread to exit. This blocks so it must be run in an executor.
+    Players that were never started only have their decoder process killed.
+    """
+    player.stop()
+    if player.is_alive():
+        player.join(timeout=timeout)
+        if player.is_alive():
+            log.warning("Media player did not exit within {}s".format(timeout))
+
+
+def probe_duration(path, use_avconv=False):
+    """ Duration of a media file in seconds as reported by ffprobe, blocks on the probe process
+
+    :return: float or None if the file couldn't be probed
+    """
+    cmd = ["avprobe" if use_avconv else "ffprobe", "-v", "error", "-show_entries", "format=duration",
+           "-of", "default=noprint_wrappers=1:nokey=1", path]
+    try:
+        return float(subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=10).strip())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+class PlaybackQueue(object):
+    """
+    Song ids and stream URLs queued to be played on a server, in play order
+    """
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self._songs = deque()
+
+    def configure(self):
+        self.max_size = int(config.get("media_queue_size", self.max_size))
+
+    def enqueue(self, item):
+        """ Add a song id or stream URL to the end of the queue
+
+        :return: Position of the item in the queue starting at 1, or None if the queue is full
+        """
+        if len(self._songs) >= self.max_size:
+            return None
+        self._songs.append(item)
+        return len(self._songs)
+
+    def pop(self):
+        return self._songs.popleft() if self._songs else None
+
+    def push_front(self, item):
+        """ Put an item back at the head of the queue, the size limit doesn't apply as it was queued before """
+        self._songs.appendleft(item)
+
+    def peek(self):
+        return self._songs[0] if self._songs else None
+
+    def shuffle(self):
+        songs = list(self._songs)
+        random.shuffle(songs)
+        self._songs = deque(songs)
+
+    def clear(self):
+        self._songs.clear()
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __iter__(self):
+        return iter(self._songs)
+
+
+class MediaController(object):
+    """
+    Owns the media player of a server. Starting and stopping a player can block on the ffmpeg process
+    so it's done in a worker thread while the transitions themselves are serialized. A request that is
+    still waiting when a newer one arrives is dropped, so only the newest request starts a player.
+
+    When a song finishes the next one from the servers queue is played, or the following song of the
+    library when media_continuous is set. The decoder for that song is spawned prefetch_lead seconds
+    before the current one ends so it has buffered audio ready for the switch.
+    """
+
+    def __init__(self, server_state, debounce=0.3, join_timeout=5.0, prefetch_lead=10.0):
+        self.server_state = server_state
+        self.debounce = debounce
+        self.join_timeout = join_timeout
+        self.prefetch_lead = prefetch_lead
+        self.state = PlayerState.idle
+        self.player = None
+        # Title of what's playing, the library path for songs
+        self.title = None
+        self._generation = 0
+        # Target of the !next requests still being debounced, so repeated requests keep advancing
+        self._pending_song_id = None
+        # (song id or stream URL, player) spawned ahead of time but not started yet
+        self._prepared = None
+        self._prefetch_handle = None
+        # Monotonic time the player was last started or had someone listening, see ServerManager.evict
+        self.used_on = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._state_changed = asyncio.Event()
+
+    def configure(self):
+        self.debounce = float(config.get("media_next_debounce", self.debounce))
+        self.join_timeout = float(config.get("media_join_timeout", self.join_timeout))
+        self.prefetch_lead = float(config.get("media_prefetch_lead", self.prefetch_lead))
+
+    @property
+    def queue(self) -> PlaybackQueue:
+        return self.server_state.queue
+
+    def _set_state(self, player_state: PlayerState):
+        self.state = player_state
+        changed, self._state_changed = self._state_changed, asyncio.Event()
+        changed.set()
+
+    async def wait_for(self, *states) -> PlayerState:
+        """ Wait until the player reaches one of the states given
+
+        :rtype: PlayerState
+        """
+        while self.state not in states:
+            await self._state_changed.wait()
+        return self.state
+
+    async def _supersede(self, delay=0.0) -> int:
+        """ Claim the next request generation, optionally waiting delay seconds for a newer request """
+        self._generation += 1
+        generation = self._generation
+        if delay:
+            await asyncio.sleep(delay)
+        return generation
+
+    def _next_item(self, pop=False, continuous=True):
+        """ The song id or stream URL to play after the current one, the queue takes precedence over the
+        library order
+
+        :param pop: Remove the item from the queue
+        :param continuous: Fall back to the following song in the library
+        """
+        if len(self.queue):
+            return self.queue.pop() if pop else self.queue.peek()
+        if not continuous:
+            return None
+        current = self._pending_song_id if self._pending_song_id is not None else self.server_state.song_id
+        if current is None:
+            return None
+        return get_library().next_song_id(int(current))
+
+    async def _play(self, item, create, volume=1.0, debounce=False):
+        """ Replace the current player with the one returned by create, unless the prefetched player
+        for item can be used
+
+        :param item: Song id or stream URL being played
+        :param create: Blocking callable returning a new, not yet started player
+        :param volume:
+        :param debounce: Wait for the debounce period and give up if a newer request arrived meanwhile
+        :return: The started player or None
+        """
+        generation = await self._supersede(self.debounce if debounce else 0.0)
+        async with self._lock:
+            if generation != self._generation or not self.server_state.voice_client:
+                return None
+            await self._stop_player()
+            self._set_state(PlayerState.starting)
+            player = await self._take_prepared(item)
+            try:
+                if player is None:
+                    player = await loop.run_in_executor(get_player_executor(), create)
+                player.volume = volume
+                await loop.run_in_executor(get_player_executor(), player.start)
+            except Exception:
+                log.exception("Failed to start media player")
+                if player is not None:
+                    await loop.run_in_executor(get_player_executor(), stop_player, player, self.join_timeout)
+                self._set_state(PlayerState.idle)
+                return None
+            self.player = player
+            self.used_on = time.monotonic()
+            self._set_state(PlayerState.playing)
+        return player
+
+    async def play_file(self, song_id, debounce=False) -> bool:
+        """ Play a song from the library, replacing the current player
+
+        :param song_id:
+        :param debounce: Wait for the debounce period and give up if a newer request arrived meanwhile
+        :return: True if the song was started
+        """
+        full_path = find_song_path(song_id, full=True)
+        if not full_path:
+            return False
+        player = await self._play(int(song_id), partial(self._create_ffmpeg, full_path), debounce=debounce)
+        if player is None:
+            return False
+        self.server_state.song_id = int(song_id)
+        self.title = find_song_path(song_id)
+        asyncio.ensure_future(self._probe_prefetch(player, full_path), loop=loop)
+        return True
+
+    async def play_url(self, url, volume=0.5, debounce=False):
+        """ Play a stream supported by youtube-dl. The extraction is served from the cache when the URL
+        was resolved before.
+
+        :return: Title of the stream or None if it wasn't started
+        """
+        try:
+            info = await ytdl.cache.resolve(url)
+        except ExtractError as err:
+            log.warning("Failed to resolve {}: {}".format(url, err))
+            return None
+        player = await self._play(url, partial(self._create_stream, info), volume, debounce)
+        if player is None:
+            return None
+        self.title = info.title or url
+        if not info.is_live:
+            self._schedule_prefetch(player, info.duration)
+        return self.title
+
+    play_youtube = play_url
+
+    def _advance(self, continuous=True):
+        """ Pop the item to play next, tracking library songs as the pending target so the following
+        request advances past it
+
+        :return: (item, True if it was taken from the queue), item is None if there is nothing to play
+        """
+        queued = len(self.queue) > 0
+        item = self._next_item(pop=True, continuous=continuous)
+        if item is not None and not isinstance(item, str):
+            self._pending_song_id = item
+        return item, queued
+
+    async def _play_item(self, item, debounce=True, queued=False) -> bool:
+        """ Start an item returned by _advance. A queued item that failed to start, eg: while not connected
+        to a voice channel, is put back at the head of the queue. It's dropped when a newer request
+        superseded it or when it can't be played at all.
+        """
+        # _play claims the next generation, anything beyond it means a newer request took over
+        generation = self._generation + 1
         try:
-            path = config["music_path"]
-        except KeyError:
-            return []
-    files = []
-    if exists(path) and isdir(path):
-        for f in listdir(path):
-            if isdir(join(path, f)):
-                for f2 in listdir(join(path, f)):
-                    if is_media_file(f2):
-                        files.append(MediaFile(join(f, f2)))
+            if isinstance(item, str):
+                started = await self.play_url(item, debounce=debounce) is not None
             else:
-                if is_media_file(f):
-                    files.append(MediaFile(f))
-        files.sort(key=attrgetter("path"))
-
-        # Store index *after* sort process
-        for idx, f in enumerate(files, start=0):
-            f.song_id = idx
-    return files
-
-
-def after_media_handler(player):
-    # try:
-    #     if not player.server_state.media_continuous:
-    #         return
-    #
-    #     from roboto.commands import TaskState, dispatcher, Commands
-    #     task = TaskState(Commands.next, [], server_id=player.server_state.server_id)
-    #     dispatcher.put_nowait(task)
-    #
-    # except Exception as err:
-    #     log.exception("Media finalizer error")
-    pass
-
-
-def play_next(server_state):
-    if server_state.song_id is not None:
-        return play_file(server_state, server_state.song_id + 1)
-    return False
-
-
-def play_file(server_state, song_id: int):
-    if not server_state.voice_client:
-        return
-    old_media_player = server_state.get_media_player()
-    if old_media_player:
-        old_media_player.is_playing()
-        old_media_player.stop()
-    avcon = config.get_bool("use_avcon", False)
-    full_path = find_song_path(song_id, full=True)
-    media_player = server_state.voice_client.create_ffmpeg_player(
-        full_path, use_avconv=avcon, after=after_media_handler)
-    media_player.volume = 1.0
-    media_player.start()
-    server_state.set_active_media_player(media_player)
-    server_state.song_id = int(song_id)
-
-    return True
+                started = await self.play_file(item, debounce=debounce)
+        finally:
+            if self._pending_song_id == item:
+                self._pending_song_id = None
+        if not started and queued and self._generation == generation:
+            self.queue.push_front(item)
+        return started
+
+    async def play_next(self, continuous=True, debounce=True) -> bool:
+        """ Skip to the next item of the queue, or song of the library. Requests made within the
+        debounce period of each other skip ahead one item each, but only the last one starts a player.
+
+        :param continuous: Fall back to the following song in the library when the queue is empty
+        :param debounce:
+        :return: True if the item was started
+        """
+        item, queued = self._advance(continuous)
+        if item is None:
+            return False
+        return await self._play_item(item, debounce, queued)
+
+    def skip(self, channel_id=None, continuous=True) -> bool:
+        """ Like play_next but returns once the target has advanced, the player is started in the
+        background. Callers serialized per server, like the dispatcher, can so issue repeated skips
+        within the debounce period and only the last one starts a player.
+
+        :param channel_id: Channel the now playing message is sent to once the item started
+        :param continuous: Fall back to the following song in the library when the queue is empty
+        :return: False if there is nothing to skip to
+        """
+        item, queued = self._advance(continuous)
+        if item is None:
+            return False
+        asyncio.ensure_future(self._skip_to(item, queued, channel_id), loop=loop)
+        return True
+
+    async def _skip_to(self, item, queued, channel_id):
+        try:
+            if await self._play_item(item, queued=queued):
+                await send_now_playing(self.server_state.server_id, channel_id)
+        except Exception:
+            log.exception("Failed to skip to the next item")
+
+    async def enqueue(self, item):
+        """ Queue a song id or stream URL, playback is started right away when nothing is playing.
+        Stream URLs are resolved in the background while they wait in the queue.
+
+        :return: Position in the queue, 0 if it started playing, NOT_PLAYED if nothing was playing but
+        starting playback failed, the item stays queued, or None if the item is invalid or the queue is full
+        """
+        if isinstance(item, str) and valid_url(item):
+            ytdl.cache.prefetch(item)
+        elif find_song_path(item):
+            item = int(item)
+        else:
+            return None
+        position = self.queue.enqueue(item)
+        if position is None:
+            return None
+        if self.state == PlayerState.idle and self._pending_song_id is None:
+            if await self.play_next(continuous=False, debounce=False):
+                return 0
+            return NOT_PLAYED
+        await self._refresh_prefetch()
+        return position
+
+    async def shuffle(self):
+        self.queue.shuffle()
+        await self._refresh_prefetch()
+
+    async def stop(self) -> bool:
+        """ Stop the player, dropping any request still waiting and the prefetched song
+
+        :return: True if a player was stopped
+        """
+        self._generation += 1
+        async with self._lock:
+            await self._discard_prepared()
+            return await self._stop_player()
+
+    def touch(self):
+        self.used_on = time.monotonic()
+
+    def is_active(self) -> bool:
+        """ A player is running or a decoder has been prefetched """
+        return self.player is not None or self._prepared is not None
+
+    async def _stop_player(self) -> bool:
+        self._cancel_prefetch()
+        player = self.player
+        if player is None:
+            return False
+        self._set_state(PlayerState.stopping)
+        self.player = None
+        self.title = None
+        await loop.run_in_executor(get_player_executor(), stop_player, player, self.join_timeout)
+        self._set_state(PlayerState.idle)
+        return True
+
+    def _create_ffmpeg(self, full_path):
+        avcon = config.get_bool("use_avcon", "false")
+        return self.server_state.voice_client.create_ffmpeg_player(full_path, use_avconv=avcon, after=self._after)
+
+    def _create_stream(self, info: ytdl.StreamInfo):
+        player = self._create_ffmpeg(info.download_url)
+        # The attributes create_ytdl_player would have set
+        player.url = info.url
+        player.download_url = info.download_url
+        player.title = info.title
+        player.duration = info.duration
+        player.is_live = info.is_live
+        return player
+
+    async def _creator(self, item):
+        """ Blocking callable creating the player for a queue item, None if the item can't be played """
+        if isinstance(item, str):
+            try:
+                info = await ytdl.cache.resolve(item)
+            except ExtractError as err:
+                log.warning("Failed to resolve {}: {}".format(item, err))
+                return None
+            return partial(self._create_stream, info)
+        full_path = find_song_path(item, full=True)
+        return partial(self._create_ffmpeg, full_path) if full_path else None
+
+    async def _probe_prefetch(self, player, full_path):
+        duration = await loop.run_in_executor(
+            get_player_executor(), probe_duration, full_path, config.get_bool("use_avcon", "false"))
+        if player is self.player:
+            self._schedule_prefetch(player, duration)
+
+    def _schedule_prefetch(self, player, duration):
+        delay = max(0.0, duration - self.prefetch_lead) if duration else 0.0
+        self._cancel_prefetch()
+        self._prefetch_handle = loop.call_later(
+            delay, lambda: asyncio.ensure_future(self._prefetch(player), loop=loop))
+
+    def _cancel_prefetch(self):
+        if self._prefetch_handle is not None:
+            self._prefetch_handle.cancel()
+            self._prefetch_handle = None
+
+    async def _prefetch(self, player):
+        """ Spawn the decoder of the next item without starting it. ffmpeg fills the pipe while the
+        current one is still playing.
+        """
+        self._prefetch_handle = None
+        item = self._next_item(continuous=self.server_state.media_continuous)
+        if player is not self.player or item is None:
+            return
+        if self._prepared is not None:
+            if self._prepared[0] == item:
+                return
+            await self._discard_prepared()
+        create = await self._creator(item)
+        if create is None or not self.server_state.voice_client:
+            return
+        try:
+            prepared = await loop.run_in_executor(get_player_executor(), create)
+        except Exception:
+            log.exception("Failed to prefetch {}".format(item))
+            return
+        if player is not self.player or self._prepared is not None:
+            await loop.run_in_executor(get_player_executor(), stop_player, prepared, self.join_timeout)
+            return
+        self._prepared = (item, prepared)
+        log.debug("Prefetched {}".format(item))
+
+    async def _refresh_prefetch(self):
+        """ Replace the prefetched item when the queue changed what plays next """
+        if self._prepared is not None and self._prepared[0] != self._next_item(
+                continuous=self.server_state.media_continuous):
+            await self._discard_prepared()
+            await self._prefetch(self.player)
+
+    async def _take_prepared(self, item):
+        """ The prefetched player if it matches item, a mismatching one is discarded """
+        if self._prepared is not None and self._prepared[0] == item:
+            player, self._prepared = self._prepared[1], None
+            return player
+        await self._discard_prepared()
+        return None
+
+    async def _discard_prepared(self):
+        if self._prepared is not None:
+            player, self._prepared = self._prepared[1], None
+            await loop.run_in_executor(get_player_executor(), stop_player, player, self.join_timeout)
+
+    def _after(self, player):
+        # Called from the player thread once it finishes
+        loop.call_soon_threadsafe(self._finished, player)
+
+    def _finished(self, player):
+        if player is not self.player or self.state != PlayerState.playing:
+            return
+        self.player = None
+        self.title = None
+        self._set_state(PlayerState.idle)
+        asyncio.ensure_future(self._auto_advance(), loop=loop)
+
+    async def _auto_advance(self):
+        try:
+            if await self.play_next(continuous=self.server_state.media_continuous, debounce=False):
+                await send_now_playing(self.server_state.server_id)
+        except Exception:
+            log.exception("Failed to advance to the next song")
+
+
+async def play_next(server_state) -> bool:
+    return await server_state.media.play_next()
+
+
+def skip(server_state, channel_id=None) -> bool:
+    return server_state.media.skip(channel_id)
+
+
+async def play_file(server_state, song_id: int) -> bool:
+    return await server_state.media.play_file(song_id)
+
+
+async def enqueue(server_state, item):
+    return await server_state.media.enqueue(item)
 
 
 def music_set_vol(player, vol):
@@ -157,34 +573,66 @@ def music_set_vol(player, vol):
         player.volume = float(vol)
 
 
-def music_stop(server):
-    player = server.get_media_player()
-    if player:
-        if player.is_playing():
-            player.stop()
-        if player.is_alive():
-            player.join(timeout=5)
-            server.set_active_media_player(None)
-        return True
-    return False
+async def music_stop(server_state) -> bool:
+    return await server_state.media.stop()
 
-ext_ip = None
 
 async def play_youtube(server_state, url, volume=0.5):
-    music_stop(server_state)
-    media_player = await server_state.voice_client.create_ytdl_player(url, use_avconv=False)
-    music_set_vol(media_player, volume)
-    media_player.start()
-    media_player.server_state = server_state
-    return media_player.title
+    return await server_state.media.play_url(url, volume)
 
 
-@lru_cache(maxsize=None)
-def music_playlist_url(server_id):
-    global ext_ip
-    try:
-        if not ext_ip:
-            ext_ip = ipgetter.myip()
-    except Exception:
-        ext_ip = "0.0.0.0"
-    return "http://{}:{}/{}".format(ext_ip, config.get("http_port", 8080), server_id)
+class PublicAddress(object):
+    """
+    External base URL of the HTTP interface. It's either configured with http_public_url or discovered
+    in a worker thread and refreshed in the background, so building a playlist URL never blocks.
+    """
+
+    def __init__(self, refresh_interval=3600.0, timeout=10.0):
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.base_url = "http://0.0.0.0:8080"
+        self.static = False
+
+    def configure(self):
+        self.refresh_interval = float(config.get("http_public_url_refresh", self.refresh_interval))
+        self.timeout = float(config.get("http_public_url_timeout", self.timeout))
+        public_url = config.get("http_public_url")
+        self.static = bool(public_url)
+        self.base_url = public_url.rstrip("/") if public_url else self.build("0.0.0.0")
+
+    @staticmethod
+    def build(ip) -> str:
+        return "http://{}:{}".format(ip, config.get("http_port", 8080))
+
+    async def refresh(self) -> bool:
+        """ Look up the external ip address
+
+        :return: True if the address was updated
+        """
+        try:
+            ip = await asyncio.wait_for(loop.run_in_executor(None, ipgetter.myip), self.timeout)
+        except asyncio.TimeoutError:
+            log.warning("Timed out looking up the external ip address")
+            return False
+        except Exception:
+            log.exception("Failed to look up the external ip address")
+            return False
+        if not ip:
+            return False
+        self.base_url = self.build(ip)
+        return True
+
+    async def run(self):
+        """ Background coroutine that will keep the discovered address up to date """
+        if self.static:
+            return
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+
+public_address = PublicAddress()
+
+
+def music_playlist_url(server_id) -> str:
+    return public_address.base_url + "/" + server_id
@@ -1,14 +1,20 @@
 import enum
 import logging
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 from sqlalchemy import Column, Enum, Integer, Unicode, ForeignKey, create_engine
-from sqlalchemy import CheckConstraint, orm
+from sqlalchemy import CheckConstraint, Index, inspect, orm
 from sqlalchemy import DateTime
 from sqlalchemy import String
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy_repr import RepresentableBase
+from roboto.exc import ValidationError
 
 
 class TaskSource(enum.Enum):
@@ -25,6 +31,69 @@ log.setLevel(logging.DEBUG)
 Base = declarative_base(cls=RepresentableBase)
 
 
+class UserCache(object):
+    """
+    LRU cache of resolved user ids keyed by (TaskSource, platform user id). Entries expire after
+    ttl seconds so a changed mapping is eventually picked up. The cache is shared with the database
+    threads so every access holds a lock.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config):
+        self.max_size = int(config.get("user_cache_size", self.max_size))
+        self.ttl = float(config.get("user_cache_ttl", self.ttl))
+
+    def get(self, key):
+        with self._lock:
+            try:
+                user_id, expires = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return user_id
+
+    def put(self, key, user_id):
+        with self._lock:
+            self._entries[key] = (user_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+user_cache = UserCache()
+
+
 class Server(Base):
     __tablename__ = "server"
 
@@ -45,6 +114,21 @@ class Server(Base):
                 raise
         return server
 
+    @classmethod
+    def get_voice_channel_id(cls, session, server_id):
+        """ The stored voice channel of a server, the server row is created when missing """
+        return cls.get(session, server_id, create=True).voice_channel_id
+
+    @classmethod
+    def set_voice_channel_ids(cls, session, changes):
+        """ Store the voice channel of several servers
+
+        :param session:
+        :param changes: list of (server_id, voice_channel_id)
+        """
+        for server_id, voice_channel_id in changes:
+            cls.get(session, server_id, create=True).voice_channel_id = voice_channel_id
+
 
 class User(Base):
     __tablename__ = 'user'
@@ -94,9 +178,53 @@ class User(Base):
             return user
         return None
 
+    @staticmethod
+    def get_id_for_source(session: orm.Session, source: TaskSource, source_user_id, create=True):
+        """ Resolve the user_id for a platform user, using the user cache when possible. Newly created
+        users are flushed so their user_id is known and cached immediately, callers must evict the
+        key again if the transaction is rolled back.
+
+        :param session:
+        :param source:
+        :param source_user_id: discord or twitch user id
+        :param create:
+        :return: user_id or None
+        """
+        user_id = user_cache.get(User.cache_key(source, source_user_id))
+        if user_id is not None:
+            return user_id
+        user = User._lookup(session, source, source_user_id, create)
+        if user is None:
+            return None
+        return user.user_id
+
+    @staticmethod
+    def _lookup(session: orm.Session, source: TaskSource, source_user_id, create):
+        if source == TaskSource.discord:
+            user = User.get(session, discord_id=source_user_id, create=create)
+        elif source == TaskSource.twitch:
+            user = User.get(session, twitch_id=source_user_id, create=create)
+        else:
+            raise ValidationError("No _user value to search with")
+        if user is not None:
+            if user.user_id is None:
+                session.flush()
+            user_cache.put(User.cache_key(source, source_user_id), user.user_id)
+        return user
+
+    @staticmethod
+    def cache_key(source: TaskSource, source_user_id):
+        if source == TaskSource.twitch and source_user_id:
+            source_user_id = source_user_id.lower()
+        return source, source_user_id
+
 
 class UserMessage(Base):
     __tablename__ = "user_messages"
+    __table_args__ = (
+        Index("ix_user_messages_server_msg", "server_id", "msg_id"),
+        Index("ix_user_messages_server_created", "server_id", "created_on"),
+    )
 
     msg_id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey(User.user_id), nullable=False)
@@ -104,23 +232,65 @@ class UserMessage(Base):
     source_id = Column(Enum(TaskSource), nullable=False)
     channel = Column(Unicode, nullable=False)
     content = Column(Unicode, nullable=False)
-    created_on = Column(DateTime, default=datetime.now())
+    created_on = Column(DateTime, default=datetime.now)
 
     user = relationship("User")
 
     @classmethod
     def record(cls, session: orm.Session, user, source, server_id, channel, message):
         msg = cls()
-        msg.user = user
+        if isinstance(user, User):
+            msg.user = user
+        else:
+            msg.user_id = user
         msg.source_id = source
         msg.server_id = server_id
         msg.content = message
         msg.channel = channel
         session.add(msg)
+        return msg
 
     @classmethod
-    def get_server_msgs(cls, session: orm.Session, server_id):
-        return session.query(UserMessage).filter_by(server_id=server_id).all()
+    def recent_floor(cls, session: orm.Session, server_id, max_rows):
+        """ Lowest msg_id of the most recent max_rows messages of a server
+
+        :return: msg_id or None if the server has fewer messages
+        """
+        return session.query(cls.msg_id).filter(cls.server_id == server_id).order_by(
+            cls.msg_id.desc()).offset(max_rows - 1).limit(1).scalar()
+
+    @classmethod
+    def iter_server_content(cls, session: orm.Session, server_id, since_msg_id=None, max_age=None,
+                            max_rows=None, chunk_size=1000):
+        """ Stream the (msg_id, content) rows of a server in msg_id order. Only the two columns are
+        selected and rows are fetched chunk_size at a time using a server side cursor where supported.
+
+        :param session:
+        :param server_id:
+        :param since_msg_id: Only messages after this msg_id
+        :param max_age: timedelta, only messages newer than this
+        :param max_rows: Only the most recent max_rows messages
+        :param chunk_size:
+        :return: generator of lists of up to chunk_size (msg_id, content) tuples
+        """
+        q = session.query(cls.msg_id, cls.content).filter(cls.server_id == server_id)
+        if since_msg_id:
+            q = q.filter(cls.msg_id > since_msg_id)
+        if max_age:
+            q = q.filter(cls.created_on >= datetime.now() - max_age)
+        if max_rows:
+            floor = cls.recent_floor(session, server_id, max_rows)
+            if floor is not None:
+                q = q.filter(cls.msg_id >= floor)
+        q = q.order_by(cls.msg_id).execution_options(stream_results=True).yield_per(chunk_size)
+        chunk = []
+        for msg_id, content in q:
+            chunk.append((msg_id, content))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
 
 class Quotes(Base):
@@ -138,20 +308,40 @@ class Quotes(Base):
         session.add(cls)
 
 
+def ensure_indexes(engine):
+    """ create_all skips tables that already exist, so add any index missing from an older schema """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                log.info("Creating index {}".format(index.name))
+                index.create(engine)
+
+
+def is_memory_db(dsn) -> bool:
+    url = make_url(dsn)
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
 def init_db(config):
-    opts = {
-        "encoding": "utf-8"
-    }
+    opts = dict()
     dsn = config.get("dsn", None)
     if not dsn:
         log.warning("Using temporary database, expect total data lost on shutdown..")
         dsn = "sqlite://"
-    if "sqlite" not in dsn:
+    if is_memory_db(dsn):
+        # Every connection to an in-memory database is a new, empty database. Share a single connection
+        # between the threads of the database pool.
+        opts.update(dict(poolclass=StaticPool, connect_args={"check_same_thread": False}))
+    elif "sqlite" not in dsn:
         opts.update(dict(pool_size=20, pool_recycle=3600))
     try:
         engine = create_engine(dsn, echo=False, **opts)
         Base.metadata.create_all(engine)
+        ensure_indexes(engine)
         Session.configure(bind=engine)
+        user_cache.configure(config)
     except Exception as err:
         print(err)
     else:
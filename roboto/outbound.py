@@ -0,0 +1,251 @@
+import asyncio
+from collections import deque
+from logging import getLogger
+from roboto import config, loop
+from roboto.model import TaskSource
+
+log = getLogger(__name__)
+
+# Kind of the now playing announcements, a queued one is dropped when a newer one is sent
+NOW_PLAYING = "now_playing"
+
+
+class RateLimit(object):
+    """
+    Allows at most N messages in any period seconds. The times of the last N sends are kept and a new
+    send waits until the oldest of them is period seconds old.
+    """
+
+    def __init__(self, messages, period):
+        """
+
+        :param messages: N, the max number of messages per period
+        :param period: Seconds
+        """
+        self.period = period
+        self._sent = deque(maxlen=max(1, messages))
+
+    def delay(self, now) -> float:
+        """ Seconds until a message can be sent """
+        if len(self._sent) < self._sent.maxlen:
+            return 0.0
+        return max(0.0, self._sent[0] + self.period - now)
+
+    def record(self, now):
+        self._sent.append(now)
+
+    def time_to_clear(self, now) -> float:
+        """ Seconds until every recorded send has left the period """
+        if not self._sent:
+            return 0.0
+        return max(0.0, self._sent[-1] + self.period - now)
+
+    async def acquire(self):
+        """ Wait until a message can be sent and record the send """
+        while True:
+            now = loop.time()
+            delay = self.delay(now)
+            if delay <= 0:
+                self.record(now)
+                return
+            await asyncio.sleep(delay)
+
+
+class OutboundMessage(object):
+    __slots__ = ("content", "kind")
+
+    def __init__(self, content, kind=None):
+        self.content = content
+        self.kind = kind
+
+
+class ChannelSender(object):
+    """
+    Queue of the messages waiting to be sent to a single channel. A worker task sends them as the
+    rate limit allows and exits once the queue is empty and the rate limit has cleared.
+    """
+
+    def __init__(self, deliver, limit: RateLimit, max_queue=20, max_length=2000, merge_length=200,
+                 separator="\n", on_idle=None):
+        """
+
+        :param deliver: Coroutine function sending a single line
+        :param limit: Rate limit, may be shared with other channels
+        :param max_queue: Messages beyond this are dropped
+        :param max_length: Longest message the platform accepts
+        :param merge_length: Adjacent messages up to this length are sent as one, 0 disables merging
+        :param separator: Joins merged messages
+        :param on_idle: Called with the sender once its worker exits
+        """
+        self.deliver = deliver
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_length = max_length
+        self.merge_length = merge_length
+        self.separator = separator
+        self.on_idle = on_idle
+        self._queue = deque()
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.superseded = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, content: str, kind=None) -> bool:
+        """ Queue a message, a queued message of the same kind is replaced by it
+
+        :param content:
+        :param kind: Messages of a kind supersede each other, None for regular messages
+        :return: False when the queue is full and the message was dropped
+        """
+        if kind is not None:
+            queued = len(self._queue)
+            self._queue = deque(m for m in self._queue if m.kind != kind)
+            self.superseded += queued - len(self._queue)
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            log.warning("Outbound queue full, dropped message")
+            return False
+        self._queue.append(OutboundMessage(content[:self.max_length], kind))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run(), loop=loop)
+        else:
+            self._wakeup.set()
+        return True
+
+    def _take(self) -> str:
+        """ Pop the next message merged with the short messages following it """
+        parts = [self._queue.popleft().content]
+        length = len(parts[0])
+        if length > self.merge_length:
+            return parts[0]
+        while self._queue:
+            content = self._queue[0].content
+            if len(content) > self.merge_length or length + len(self.separator) + len(content) > self.max_length:
+                break
+            self._queue.popleft()
+            parts.append(content)
+            length += len(self.separator) + len(content)
+        self.merged += len(parts) - 1
+        return self.separator.join(parts)
+
+    async def _run(self):
+        try:
+            while True:
+                while self._queue:
+                    await self.limit.acquire()
+                    if not self._queue:
+                        break
+                    line = self._take()
+                    try:
+                        await self.deliver(line)
+                        self.sent += 1
+                    except Exception:
+                        log.exception("Failed to send message")
+                # Linger until the rate limit has cleared so dropping the sender doesn't reset it
+                idle = self.limit.time_to_clear(loop.time())
+                if idle <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), idle)
+                except asyncio.TimeoutError:
+                    if not self._queue:
+                        break
+        finally:
+            self._task = None
+            if self.on_idle is not None and not self._queue:
+                self.on_idle(self)
+
+
+class Outbox(object):
+    """
+    Rate limited, per channel sending of chat messages. Discord limits each channel separately while
+    twitch limits the account as a whole, so twitch channels share a single rate limit.
+    """
+
+    def __init__(self):
+        self.discord_rate = (5, 5.0)
+        self.twitch_rate = (20, 30.0)
+        self.max_queue = 20
+        self.merge_length = 200
+        self._twitch_limit = None
+        self._senders = dict()
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.superseded = 0
+
+    def configure(self):
+        self.discord_rate = (int(config.get("outbound_discord_messages", self.discord_rate[0])),
+                             float(config.get("outbound_discord_period", self.discord_rate[1])))
+        self.twitch_rate = (int(config.get("outbound_twitch_messages", self.twitch_rate[0])),
+                            float(config.get("outbound_twitch_period", self.twitch_rate[1])))
+        self.max_queue = int(config.get("outbound_queue_size", self.max_queue))
+        self.merge_length = int(config.get("outbound_merge_length", self.merge_length))
+        self._twitch_limit = None
+
+    def _create_sender(self, source: TaskSource, client, channel_id) -> ChannelSender:
+        if source == TaskSource.discord:
+            async def deliver(line):
+                channel = client.get_channel(channel_id)
+                if channel is None:
+                    log.warning("Failed to find channel {}".format(channel_id))
+                    return
+                await client.send_message(channel, line)
+
+            return ChannelSender(deliver, RateLimit(*self.discord_rate), self.max_queue, 2000,
+                                 self.merge_length, "\n", self._remove)
+
+        async def deliver(line):
+            client.privmsg(channel_id, line)
+
+        if self._twitch_limit is None:
+            self._twitch_limit = RateLimit(*self.twitch_rate)
+        return ChannelSender(deliver, self._twitch_limit, self.max_queue, 500, self.merge_length, " | ",
+                             self._remove)
+
+    def _remove(self, sender: ChannelSender):
+        for key, value in list(self._senders.items()):
+            if value is sender:
+                del self._senders[key]
+        self.sent += sender.sent
+        self.merged += sender.merged
+        self.dropped += sender.dropped
+        self.superseded += sender.superseded
+
+    def send(self, source: TaskSource, client, channel_id, message: str, kind=None) -> bool:
+        """ Queue a message for a discord or twitch channel
+
+        :param source: Platform of the channel
+        :param client: discord.Client or irc3.IrcBot
+        :param channel_id: Discord channel id or twitch channel name
+        :param message:
+        :param kind: Messages of a kind supersede each other, eg: NOW_PLAYING
+        :return: False if the message was dropped
+        """
+        if not message:
+            return False
+        key = (source, channel_id)
+        sender = self._senders.get(key)
+        if sender is None:
+            sender = self._senders[key] = self._create_sender(source, client, channel_id)
+        return sender.put(message, kind)
+
+    def stats(self) -> dict:
+        senders = list(self._senders.values())
+        return {
+            "channels": len(senders),
+            "queued": sum(len(s) for s in senders),
+            "sent": self.sent + sum(s.sent for s in senders),
+            "merged": self.merged + sum(s.merged for s in senders),
+            "dropped": self.dropped + sum(s.dropped for s in senders),
+            "superseded": self.superseded + sum(s.superseded for s in senders)
+        }
+
+
+outbox = Outbox()
@@ -1,18 +1,16 @@
+import asyncio
+from logging import getLogger
 import aiohttp
+from roboto import config, loop
+
+log = getLogger(__name__)
 
 headers = {
     'User-Agent': 'Rotobot 1.0'
 }
 
-async def get_player_stats(battle_tag, region="us"):
-    url = u"https://owapi.net/api/v3/u/{}/stats".format(battle_tag)
-    d = None
-    async with aiohttp.get(url, headers=headers) as r:
-        if r.status == 200:
-            d = await r.json()
-    if not d:
-        return
 
+def parse_player_stats(d, region="us"):
     region_key = ""
     regions = {"kr", "eu", "us"}
     if region.lower() not in regions:
@@ -53,4 +51,94 @@ async def get_player_stats(battle_tag, region="us"):
         "level": level,
         "elims": elims,
         "deaths": deaths
-    }
\ No newline at end of file
+    }
+
+
+class StatsClient(object):
+    """
+    owapi client sharing a single HTTP session. Parsed results are cached per (battle_tag, region),
+    concurrent requests for the same player share one fetch and an expired result is served when
+    the upstream doesn't answer within stale_timeout seconds.
+    """
+
+    def __init__(self, base_url="https://owapi.net", ttl=300.0, timeout=10.0, stale_timeout=2.0, max_size=1000):
+        self.base_url = base_url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.max_size = max_size
+        self._session = None
+        # (battle_tag, region) -> (expires, stats)
+        self._cache = dict()
+        self._in_flight = dict()
+
+    def configure(self):
+        self.base_url = config.get("owapi_url", self.base_url).rstrip("/")
+        self.ttl = float(config.get("rank_cache_ttl", self.ttl))
+        self.timeout = float(config.get("rank_timeout", self.timeout))
+        self.stale_timeout = float(config.get("rank_stale_timeout", self.stale_timeout))
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(headers=headers)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_player_stats(self, battle_tag, region="us"):
+        """ Fetch the parsed stats for a player
+
+        :param battle_tag: bnet id with the # replaced by a -
+        :param region:
+        :return: dict of stats or None if they couldn't be retrieved
+        """
+        key = (battle_tag.lower(), region.lower())
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > loop.time():
+            return cached[1]
+        fetch = self._in_flight.get(key)
+        if fetch is None:
+            fetch = self._in_flight[key] = asyncio.ensure_future(self._fetch(battle_tag, key), loop=loop)
+            fetch.add_done_callback(lambda f: self._fetch_done(key, f))
+        try:
+            if cached is not None:
+                return await asyncio.wait_for(asyncio.shield(fetch), self.stale_timeout) or cached[1]
+            return await asyncio.shield(fetch)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError):
+            if cached is not None:
+                log.debug("Serving stale stats for {}".format(battle_tag))
+                return cached[1]
+            return None
+
+    def _fetch_done(self, key, fetch: asyncio.Future):
+        self._in_flight.pop(key, None)
+        if not fetch.cancelled() and fetch.exception() is not None:
+            log.warning("Failed to fetch stats for {}: {!r}".format(key[0], fetch.exception()))
+
+    async def _fetch(self, battle_tag, key):
+        url = u"{}/api/v3/u/{}/stats".format(self.base_url, battle_tag)
+        d = await asyncio.wait_for(self._request(url), self.timeout)
+        if not d:
+            return None
+        stats = parse_player_stats(d, key[1])
+        self._cache.pop(key, None)
+        self._cache[key] = (loop.time() + self.ttl, stats)
+        while len(self._cache) > self.max_size:
+            del self._cache[next(iter(self._cache))]
+        return stats
+
+    async def _request(self, url):
+        async with self.session().get(url) as r:
+            if r.status == 200:
+                return await r.json()
+        return None
+
+
+client = StatsClient()
+
+
+async def get_player_stats(battle_tag, region="us"):
+    return await client.get_player_stats(battle_tag, region)
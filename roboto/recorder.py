@@ -0,0 +1,169 @@
+import asyncio
+import time
+from logging import getLogger
+from roboto import config, loop
+from roboto.db import database
+from roboto.exc import ValidationError
+from roboto.model import Session, User, UserMessage, TaskSource, user_cache
+
+log = getLogger(__name__)
+
+
+class MessageRecorder(object):
+    """
+    Write-behind buffer for chat messages. Messages are queued and written to the database in
+    batches once either the batch size or the flush interval is reached.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=1.0, max_queue=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._running = False
+        # Batch currently being collected by run, kept so close can write it out
+        self._batch = []
+        self.batches = 0
+        self.messages = 0
+        self.skipped = 0
+        self.last_batch_size = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def configure(self):
+        """ Apply the config values, must be called before the recorder is started """
+        self.batch_size = int(config.get("record_batch_size", self.batch_size))
+        self.flush_interval = float(config.get("record_flush_interval", self.flush_interval))
+        self._queue = asyncio.Queue(maxsize=int(config.get("record_queue_size", self._queue.maxsize)))
+
+    async def add(self, source, user_id, server_id, channel, content):
+        """ Queue a message to be recorded. Blocks the producer when the queue is full.
+
+        :param source: TaskSource
+        :param user_id: discord or twitch user id
+        :param server_id:
+        :param channel:
+        :param content:
+        """
+        await self._queue.put((source, user_id, server_id, channel, content))
+
+    def _next_batch(self, batch):
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def run(self):
+        """ Background coroutine that will flush the queued messages
+
+        :return:
+        """
+        self._running = True
+        while self._running:
+            self._batch = batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(self._next_batch(batch)) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._batch = []
+            try:
+                await self._fold(await database.run(self.flush, batch))
+            except Exception:
+                log.exception("Error flushing recorded messages")
+
+    def flush(self, batch):
+        """ Write a batch of messages in a single transaction. This blocks, run uses the database pool.
+
+        :param batch: list of queued message tuples
+        :return: list of (server_id, content, msg_id) for the stored messages
+        """
+        start = time.perf_counter()
+        users = dict()
+        session = Session()
+        try:
+            msgs = []
+            for source, user_id, server_id, channel, content in batch:
+                key = (source, user_id)
+                if key not in users:
+                    users[key] = self._resolve_user(session, source, user_id)
+                if users[key] is None or not (server_id and channel and content):
+                    # A single invalid message must not cost the rest of the batch
+                    self.skipped += 1
+                    log.warning("Skipped invalid message from {} in {}".format(user_id, server_id))
+                    continue
+                msgs.append(UserMessage.record(session, users[key], source, server_id, channel, content))
+            session.flush()
+            stored = [(m.server_id, m.content, m.msg_id) for m in msgs]
+            session.commit()
+        except Exception:
+            session.rollback()
+            # Users created in this transaction no longer exist
+            for source, user_id in users:
+                user_cache.evict(User.cache_key(source, user_id))
+            log.exception("Failed to record {} messages".format(len(batch)))
+            return []
+        finally:
+            session.close()
+        self.batches += 1
+        self.messages += len(stored)
+        self.last_batch_size = len(stored)
+        self.last_flush_latency = time.perf_counter() - start
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        log.debug("Recorded {} messages in {:.3f}s".format(len(stored), self.last_flush_latency))
+        return stored
+
+    @staticmethod
+    def _resolve_user(session, source, user_id):
+        """
+
+        :return: user_id or None if the message can't be attributed to a user
+        """
+        if source not in (TaskSource.discord, TaskSource.twitch) or not user_id:
+            return None
+        try:
+            return User.get_id_for_source(session, source, user_id)
+        except ValidationError:
+            return None
+
+    @staticmethod
+    async def _fold(stored):
+        from roboto.state import servers
+        for server_id, content, msg_id in stored:
+            server = await servers.get_server(server_id)
+            server.add_markov_message(content, msg_id=msg_id)
+
+    def close(self):
+        """ Stop the recorder and synchronously write out everything still queued. The stored messages
+        are picked up by the markov snapshot replay on the next startup.
+        """
+        self._running = False
+        try:
+            if self._batch:
+                self.flush(self._batch)
+                self._batch = []
+            while not self._queue.empty():
+                self.flush(self._next_batch([]))
+        except Exception:
+            # Called during shutdown, the remaining shutdown steps must still run
+            log.exception("Failed to write the queued messages")
+        log.info("Recorder stats: {}".format(self.stats()))
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "messages": self.messages,
+            "skipped": self.skipped,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency
+        }
+
+
+recorder = MessageRecorder()
@@ -0,0 +1,204 @@
+import asyncio
+import gzip
+import json
+import os
+from datetime import datetime, date, timedelta
+from logging import getLogger
+from os.path import join
+from sqlalchemy import or_
+from sqlalchemy.exc import DBAPIError
+from roboto import config
+from roboto.db import database
+from roboto.model import Session, UserMessage
+
+log = getLogger(__name__)
+
+
+def parse_days(value):
+    """ Config value in days as a timedelta, None when unset or 0 """
+    days = float(value or 0)
+    return timedelta(days=days) if days > 0 else None
+
+
+def parse_rows(value):
+    rows = int(value or 0)
+    return rows if rows > 0 else None
+
+
+class RetentionPolicy(object):
+    """
+    How many messages of a server are kept, by age and/or by count. None disables a limit.
+    """
+    __slots__ = ("max_age", "max_rows")
+
+    def __init__(self, max_age=None, max_rows=None):
+        self.max_age = max_age
+        self.max_rows = max_rows
+
+    def __bool__(self):
+        return bool(self.max_age or self.max_rows)
+
+
+class MessagePruner(object):
+    """
+    Deletes the recorded messages falling outside of their servers retention policy. Rows are deleted
+    in small batches, each in its own short transaction run in a worker thread, with a pause between
+    batches so other writers aren't locked out. Pruned rows can be appended to gzipped JSONL archives
+    before they're deleted.
+
+    The default policy comes from retention_max_age (days) and retention_max_rows. Both can be
+    overridden per server with retention_max_age.<server_id> and retention_max_rows.<server_id>.
+    """
+
+    def __init__(self, batch_size=500, interval=3600.0, pause=0.1, archive_path=None):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self.archive_path = archive_path
+        self.default = RetentionPolicy()
+        self.policies = dict()
+        self.pruned = 0
+        self.archived = 0
+        self.last_run = None
+
+    def configure(self):
+        self.batch_size = int(config.get("retention_batch_size", self.batch_size))
+        self.interval = float(config.get("retention_interval", self.interval))
+        self.pause = float(config.get("retention_pause", self.pause))
+        self.archive_path = config.get("retention_archive_path", self.archive_path) or None
+        self.default = RetentionPolicy(parse_days(config.get("retention_max_age")),
+                                       parse_rows(config.get("retention_max_rows")))
+        self.policies = dict()
+        for key, value in config.items():
+            name, _, server_id = key.partition(".")
+            if not server_id or name not in ("retention_max_age", "retention_max_rows"):
+                continue
+            policy = self.policies.setdefault(server_id, RetentionPolicy(self.default.max_age, self.default.max_rows))
+            if name == "retention_max_age":
+                policy.max_age = parse_days(value)
+            else:
+                policy.max_rows = parse_rows(value)
+
+    def policy(self, server_id) -> RetentionPolicy:
+        return self.policies.get(server_id, self.default)
+
+    def enabled(self) -> bool:
+        return bool(self.default) or any(self.policies.values())
+
+    @staticmethod
+    def server_ids():
+        session = Session()
+        try:
+            return [server_id for server_id, in session.query(UserMessage.server_id).distinct()]
+        finally:
+            session.close()
+
+    def prune_batch(self, server_id) -> int:
+        """ Delete, and archive, a single batch of expired messages. This blocks on the database so it
+        must be run in an executor.
+
+        :return: Number of messages deleted
+        """
+        policy = self.policy(server_id)
+        session = Session()
+        try:
+            expired = []
+            if policy.max_rows:
+                floor = UserMessage.recent_floor(session, server_id, policy.max_rows)
+                if floor is not None:
+                    expired.append(UserMessage.msg_id < floor)
+            if policy.max_age:
+                expired.append(UserMessage.created_on < datetime.now() - policy.max_age)
+            if not expired:
+                return 0
+            rows = session.query(
+                UserMessage.msg_id, UserMessage.user_id, UserMessage.source_id, UserMessage.channel,
+                UserMessage.content, UserMessage.created_on
+            ).filter(UserMessage.server_id == server_id, or_(*expired)).order_by(
+                UserMessage.msg_id).limit(self.batch_size).all()
+            if not rows:
+                return 0
+            if self.archive_path:
+                self.archive(server_id, rows)
+            session.query(UserMessage).filter(UserMessage.msg_id.in_([row[0] for row in rows])).delete(
+                synchronize_session=False)
+            session.commit()
+        except DBAPIError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self.pruned += len(rows)
+        return len(rows)
+
+    def archive(self, server_id, rows):
+        """ Append the rows to the servers archive of the day, gzip members are appended so the file
+        reads as one stream.
+        """
+        os.makedirs(self.archive_path, exist_ok=True)
+        path = join(self.archive_path, "{}-{}.jsonl.gz".format(server_id, date.today().strftime("%Y%m%d")))
+        with gzip.open(path, "at", encoding="utf-8") as fp:
+            for msg_id, user_id, source, channel, content, created_on in rows:
+                fp.write(json.dumps({
+                    "msg_id": msg_id,
+                    "user_id": user_id,
+                    "server_id": server_id,
+                    "source": source.name if source else None,
+                    "channel": channel,
+                    "content": content,
+                    "created_on": created_on.isoformat() if created_on else None
+                }) + "\n")
+        self.archived += len(rows)
+
+    async def prune_server(self, server_id) -> int:
+        """ Prune a server batch by batch until nothing expired is left
+
+        :return: Number of messages deleted
+        """
+        total = 0
+        while True:
+            deleted = await database.run(self.prune_batch, server_id)
+            total += deleted
+            if deleted < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        if total:
+            log.info("Pruned {} messages of {}".format(total, server_id))
+        return total
+
+    async def prune(self) -> int:
+        """ Prune every server that has a retention policy
+
+        :return: Number of messages deleted
+        """
+        total = 0
+        for server_id in await database.run(self.server_ids):
+            if not self.policy(server_id):
+                continue
+            try:
+                total += await self.prune_server(server_id)
+            except (DBAPIError, OSError):
+                log.exception("Failed to prune messages of {}".format(server_id))
+        self.last_run = datetime.now()
+        return total
+
+    async def run(self):
+        """ Background coroutine that will prune messages every interval seconds """
+        if not self.enabled():
+            return
+        while True:
+            try:
+                await self.prune()
+            except Exception:
+                log.exception("Error pruning messages")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "pruned": self.pruned,
+            "archived": self.archived,
+            "last_run": self.last_run
+        }
+
+
+pruner = MessagePruner()
@@ -1,20 +1,98 @@
+import asyncio
+import time
+from logging import getLogger
 import discord
 from discord.voice_client import StreamPlayer
+from sqlalchemy.exc import DBAPIError
+from roboto import config, loop
 from roboto.commands import dispatcher, TaskState, Commands
+from roboto.db import database
+from roboto.model import Session, Server
+
+log = getLogger(__name__)
 
 
 class ServerState(object):
 
     def __init__(self, server_id):
-        from roboto import text
+        from roboto import media
         self.server_id = server_id
         self._voice_channel_id = None
-        self._media_player = None
-        self.markov_model = text.MarkovModel(server_id)
+        # Voice channel as last written to the database and whether a change is waiting to be written
+        self._stored_voice_channel_id = None
+        self._voice_dirty = False
+        self.queue = media.PlaybackQueue()
+        self.queue.configure()
+        self.media = media.MediaController(self)
+        self.media.configure()
+        # Created on first use and dropped again by ServerManager.evict once idle
+        self._markov_model = None
+        self.markov_used_on = 0.0
         self.ready_state = False
         self.voice_client = None
         self.media_continuous = True
-        self.song_id = None
+        self._song_id = None
+        # Wall clock time of the last song change, used as Last-Modified of the playlist page
+        self.song_changed_on = 0.0
+
+    @property
+    def song_id(self):
+        return self._song_id
+
+    @song_id.setter
+    def song_id(self, song_id):
+        if song_id != self._song_id:
+            self._song_id = song_id
+            self.song_changed_on = time.time()
+
+    @property
+    def markov_model(self):
+        """ The markov model of the server, created on first access. The chain itself is only loaded
+        by get_markov_model.
+
+        :rtype: roboto.text.MarkovModel
+        """
+        if self._markov_model is None:
+            from roboto import text
+            self._markov_model = text.MarkovModel(self.server_id)
+        self.markov_used_on = time.monotonic()
+        return self._markov_model
+
+    async def get_markov_model(self):
+        """ The markov model of the server with its chain loaded
+
+        :rtype: roboto.text.MarkovModel
+        """
+        model = self.markov_model
+        await model.ensure_loaded()
+        return model
+
+    def has_markov_model(self) -> bool:
+        return self._markov_model is not None
+
+    def add_markov_message(self, content: str, msg_id=None) -> bool:
+        """ Fold a recorded message into the chain if it's loaded or being loaded. Messages of unloaded
+        chains are picked up from the database once the chain is loaded.
+
+        :return: True if the message was folded in or queued
+        """
+        model = self._markov_model
+        if model is None or not (model.loaded or model.building):
+            return False
+        model.add_message(content, msg_id=msg_id)
+        return True
+
+    def evict_markov_model(self):
+        """ Drop the markov model, unless its chain is currently being built
+
+        :return: The dropped model or None
+        :rtype: roboto.text.MarkovModel
+        """
+        model = self._markov_model
+        if model is None or model.building:
+            return None
+        self._markov_model = None
+        return model
 
     async def on_connect(self):
         task = TaskState(Commands.server_connect, [], server_id=self.server_id)
@@ -24,16 +102,42 @@ class ServerState(object):
     def has_voice(self) -> bool:
         return self._voice_channel_id
 
-    def set_voice_channel(self, channel_id: str):
+    def set_voice_channel(self, channel_id: str, stored=False) -> bool:
+        """ Track the voice channel of the bot. Changes are written to the database in batches by the
+        ServerManager.
+
+        :param channel_id:
+        :param stored: The value was read from the database and doesn't need to be written
+        :return: True if the channel changed
+        """
+        changed = channel_id != self._voice_channel_id
         self._voice_channel_id = channel_id
+        if stored:
+            self._stored_voice_channel_id = channel_id
+        elif changed:
+            self._voice_dirty = True
+        return changed
+
+    def take_voice_change(self):
+        """ The pending voice channel change, clearing it
 
-    def set_active_media_player(self, media_player):
-        self._media_player = media_player
-        if media_player:
-            media_player.server_state = self if media_player else None
+        :return: (server_id, channel_id) or None when the stored value is current
+        """
+        if not self._voice_dirty:
+            return None
+        self._voice_dirty = False
+        if self._voice_channel_id == self._stored_voice_channel_id:
+            return None
+        return self.server_id, self._voice_channel_id
+
+    def voice_change_written(self, channel_id, success=True):
+        if success:
+            self._stored_voice_channel_id = channel_id
+        elif channel_id == self._voice_channel_id:
+            self._voice_dirty = True
 
     def get_media_player(self) -> StreamPlayer:
-        return self._media_player
+        return self.media.player
 
     def get_voice_channel(self, client: discord.Client) -> discord.Channel:
         channel = client.get_channel(self._voice_channel_id)
@@ -41,27 +145,173 @@ class ServerState(object):
 
 
 class ServerManager(object):
-    def __init__(self):
+    """
+    Holds the state of every server. A ServerState is cheap, the expensive parts are created on first
+    use and released again by evict:
+
+    - Markov models not used for markov_idle_timeout seconds are dropped, as are the least recently used
+      ones beyond markov_max_models. A snapshot is saved first so reloading them is fast.
+    - Media players of servers without anyone listening for media_idle_timeout seconds are stopped.
+    """
+
+    def __init__(self, markov_max_models=100, markov_idle_timeout=3600.0, media_idle_timeout=600.0):
         self._servers = dict()
+        self.markov_max_models = markov_max_models
+        self.markov_idle_timeout = markov_idle_timeout
+        self.media_idle_timeout = media_idle_timeout
+        self.markov_evicted = 0
+        self.media_evicted = 0
+
+    def configure(self):
+        self.markov_max_models = int(config.get("markov_max_models", self.markov_max_models))
+        self.markov_idle_timeout = float(config.get("markov_idle_timeout", self.markov_idle_timeout))
+        self.media_idle_timeout = float(config.get("media_idle_timeout", self.media_idle_timeout))
 
     def __len__(self):
-        return len([self._servers.keys()])
+        return len(self._servers)
 
     async def get_server(self, server_id: str) -> ServerState:
-        """
+        """ Get the state of a server, creating it on first use. The state is registered before the
+        connect event is queued so concurrent callers share a single instance.
 
         :param server_id:
         :return:
         :rtype: roboto.state.ServerState
         """
+        server = self._servers.get(server_id)
+        if server is None:
+            server = self._servers[server_id] = ServerState(server_id)
+            await server.on_connect()
+        return server
+
+    async def evict_markov_models(self) -> int:
+        """ Drop the idle and least recently used markov models, saving their snapshots first
+
+        :return: Number of models dropped
+        """
+        now = time.monotonic()
+        loaded = sorted((s for s in self._servers.values() if s.has_markov_model()), key=lambda s: s.markov_used_on)
+        excess = len(loaded) - self.markov_max_models
+        evicted = 0
+        for idx, server in enumerate(loaded):
+            if idx >= excess and now - server.markov_used_on < self.markov_idle_timeout:
+                continue
+            model = server.evict_markov_model()
+            if model is None:
+                continue
+            evicted += 1
+            try:
+                await loop.run_in_executor(None, model.save_snapshot)
+            except OSError:
+                log.exception("Failed to save markov snapshot for {}".format(server.server_id))
+        self.markov_evicted += evicted
+        return evicted
+
+    async def evict_media_players(self, client: discord.Client) -> int:
+        """ Stop the players of servers where nobody has been listening for media_idle_timeout seconds
+
+        :return: Number of players stopped
+        """
+        now = time.monotonic()
+        evicted = 0
+        for server in list(self._servers.values()):
+            if not server.media.is_active():
+                continue
+            channel = server.get_voice_channel(client)
+            if channel is not None and any(not member.bot for member in channel.voice_members):
+                server.media.touch()
+            elif now - server.media.used_on >= self.media_idle_timeout:
+                log.debug("Stopping idle media player of {}".format(server.server_id))
+                await server.media.stop()
+                evicted += 1
+        self.media_evicted += evicted
+        return evicted
+
+    async def evict(self):
+        from roboto.disc import dc
+        await self.evict_markov_models()
+        await self.evict_media_players(dc)
+
+    async def run_evictor(self, interval=60.0):
+        """ Background coroutine that will evict idle server state every interval seconds """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict()
+            except Exception:
+                log.exception("Error evicting idle server state")
+
+    def stats(self) -> dict:
+        return {
+            "servers": len(self),
+            "markov_models": sum(1 for s in self._servers.values() if s.has_markov_model()),
+            "markov_evicted": self.markov_evicted,
+            "media_evicted": self.media_evicted
+        }
+
+    def _take_voice_changes(self) -> list:
+        changes = []
+        for server in self._servers.values():
+            change = server.take_voice_change()
+            if change is not None:
+                changes.append(change)
+        return changes
+
+    def _voice_changes_written(self, changes, success=True):
+        for server_id, channel_id in changes:
+            server = self._servers.get(server_id)
+            if server is not None:
+                server.voice_change_written(channel_id, success)
+
+    async def flush_voice_states(self) -> int:
+        """ Write the changed voice channels of all servers in a single transaction
+
+        :return: Number of servers written
+        """
+        changes = self._take_voice_changes()
+        if not changes:
+            return 0
         try:
-            return self._servers[server_id]
-        except KeyError:
-            server = ServerState(server_id)
-            if not server.ready_state:
-                await server.on_connect()
-            self._servers[server_id] = server
-            return server
+            await database.run_in_session(Server.set_voice_channel_ids, changes)
+        except DBAPIError:
+            log.exception("Failed to write voice states")
+            self._voice_changes_written(changes, success=False)
+            return 0
+        self._voice_changes_written(changes)
+        return len(changes)
+
+    async def run_voice_writer(self, interval=5.0):
+        """ Background coroutine that will write voice channel changes every interval seconds """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_voice_states()
+            except Exception:
+                log.exception("Error writing voice states")
+
+    def save_voice_states(self):
+        """ Synchronously write the pending voice channel changes, used on shutdown """
+        changes = self._take_voice_changes()
+        if not changes:
+            return
+        session = Session()
+        try:
+            Server.set_voice_channel_ids(session, changes)
+            session.commit()
+        except DBAPIError:
+            session.rollback()
+            log.exception("Failed to write voice states")
+        finally:
+            session.close()
+
+    def save_markov_snapshots(self):
+        for server in self._servers.values():
+            if not server.has_markov_model():
+                continue
+            try:
+                server._markov_model.save_snapshot()
+            except OSError:
+                log.exception("Failed to save markov snapshot for {}".format(server.server_id))
 
 
 servers = ServerManager()
@@ -0,0 +1,52 @@
+import asyncio
+from logging import getLogger
+from roboto import config
+
+log = getLogger(__name__)
+
+
+class StatsReporter(object):
+    """
+    Periodically logs the counters of the registered components, a line per component. An interval
+    of 0 disables the reports.
+    """
+
+    def __init__(self, interval=300.0):
+        self.interval = interval
+        self._sources = []
+
+    def configure(self):
+        self.interval = float(config.get("stats_interval", self.interval))
+
+    def register(self, name, source):
+        """ Add a component to the reports
+
+        :param name: Prefix of the log line
+        :param source: Callable returning a dict of the counters, eg: Database.stats
+        """
+        self._sources.append((name, source))
+
+    def collect(self) -> dict:
+        """ The current counters of every component, keyed by name """
+        stats = dict()
+        for name, source in self._sources:
+            try:
+                stats[name] = source()
+            except Exception:
+                log.exception("Failed to collect the {} stats".format(name))
+        return stats
+
+    def report(self):
+        for name, values in self.collect().items():
+            log.info("{}: {}".format(name, " ".join("{}={}".format(k, v) for k, v in values.items())))
+
+    async def run(self):
+        """ Background coroutine that will log the stats every interval seconds """
+        if self.interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+
+reporter = StatsReporter()
@@ -1,9 +1,21 @@
+import asyncio
+import os
 import string
+import struct
+import sys
+import threading
+from array import array
+from collections import deque
+from datetime import timedelta
+from itertools import accumulate
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from logging import getLogger
+from os.path import join, exists
 from urllib.parse import urlparse
 import markovify
+from markovify.chain import BEGIN, END
 from sqlalchemy import orm
-from roboto import config
+from roboto import config, loop
 
 
 valid_url_schemas = ("http", "https")
@@ -18,24 +30,488 @@ def valid_url(url: str, allowed_domains=None) -> bool:
     return u.scheme in valid_url_schemas and u.netloc
 
 
+_build_executor = None
+_generate_executor = None
+_build_limit = None
+_load_limit = None
+
+
+def executor_enabled() -> bool:
+    return config.get_bool("markov_executor", "true")
+
+
+def get_build_executor() -> ProcessPoolExecutor:
+    global _build_executor
+    if _build_executor is None:
+        _build_executor = ProcessPoolExecutor(max_workers=int(config.get("markov_build_workers", 2)))
+    return _build_executor
+
+
+def get_generate_executor() -> ThreadPoolExecutor:
+    global _generate_executor
+    if _generate_executor is None:
+        _generate_executor = ThreadPoolExecutor(max_workers=int(config.get("markov_generate_workers", 2)))
+    return _generate_executor
+
+
+def get_build_limit() -> asyncio.Semaphore:
+    """ Limits how many chains are built concurrently across all servers
+
+    :rtype: asyncio.Semaphore
+    """
+    global _build_limit
+    if _build_limit is None:
+        _build_limit = asyncio.Semaphore(int(config.get("markov_build_concurrency", 2)))
+    return _build_limit
+
+
+def get_load_limit() -> asyncio.Semaphore:
+    """ Limits how many chains are loaded, from a snapshot or by a rebuild, concurrently. Chains are
+    loaded lazily on first use so this mainly bounds the burst of loads after a restart.
+
+    :rtype: asyncio.Semaphore
+    """
+    global _load_limit
+    if _load_limit is None:
+        _load_limit = asyncio.Semaphore(int(config.get("markov_load_concurrency", 2)))
+    return _load_limit
+
+
+def shutdown_executors():
+    global _build_executor, _generate_executor
+    for executor in (_build_executor, _generate_executor):
+        if executor is not None:
+            executor.shutdown(wait=False)
+    _build_executor = None
+    _generate_executor = None
+
+
+def corpus_window():
+    """ The window of recent messages a chain is rebuilt from, markov_corpus_max_age is in days
+
+    :return: (max_age timedelta or None, max_rows or None)
+    """
+    max_age = float(config.get("markov_corpus_max_age", 0))
+    max_rows = int(config.get("markov_corpus_max_rows", 0))
+    return timedelta(days=max_age) if max_age > 0 else None, max_rows if max_rows > 0 else None
+
+
+def build_model(lines, state_size=2):
+    """ Build a new markovify model from the lines given. Each line is split into sentences on its own
+    so messages never run together. The original text is not retained, it would otherwise have to
+    be rebuilt on every incremental update.
+
+    This is a module level function so it can be executed in a worker process.
+
+    :param lines: iterable of message content
+    :param state_size:
+    :return: markovify.Text or None if no usable sentences were found
+    """
+    try:
+        return markovify.Text(lines, state_size=state_size, retain_original=False)
+    except KeyError:
+        # markovify cannot compute a begin state for an empty corpus
+        return None
+
+
+# Bump whenever the on disk snapshot layout changes, older snapshots are then ignored
+SNAPSHOT_VERSION = 2
+_snapshot_magic = b"RMKV"
+# magic, version, state_size, high water msg_id
+_snapshot_header = struct.Struct("<4sHHq")
+# Element count of the arrays and byte length of the word table that follow it
+_snapshot_length = struct.Struct("<I")
+
+
+def encode_chain(chain_model: dict):
+    """ Flatten a markovify chain into a word table and integer arrays. The states are stored as
+    state_size word indexes each, the transitions of state i are the entries offsets[i]:offsets[i + 1]
+    of the follows and counts arrays.
+
+    :param chain_model: markovify.Chain.model
+    :return: (words, states, offsets, follows, counts)
+    """
+    words = []
+    word_idx = {}
+
+    def idx(word):
+        try:
+            return word_idx[word]
+        except KeyError:
+            word_idx[word] = len(words)
+            words.append(word)
+            return word_idx[word]
+
+    states = array("I")
+    offsets = array("I", [0])
+    follows = array("I")
+    counts = array("I")
+    for state, next_words in chain_model.items():
+        states.extend(idx(w) for w in state)
+        follows.extend(idx(w) for w in next_words.keys())
+        counts.extend(next_words.values())
+        offsets.append(len(follows))
+    return words, states, offsets, follows, counts
+
+
+def decode_chain(words, states, offsets, follows, counts, state_size) -> dict:
+    lookup = words.__getitem__
+    chain_model = {}
+    for i in range(len(offsets) - 1):
+        state = tuple(map(lookup, states[i * state_size:(i + 1) * state_size]))
+        start, end = offsets[i], offsets[i + 1]
+        chain_model[state] = dict(zip(map(lookup, follows[start:end]), counts[start:end]))
+    return chain_model
+
+
+def _write_array(fp, values: array):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    fp.write(_snapshot_length.pack(len(values)))
+    fp.write(values.tobytes())
+
+
+def _read_array(view: memoryview, offset):
+    """
+
+    :return: (array, offset past the array)
+    """
+    count, = _snapshot_length.unpack_from(view, offset)
+    offset += _snapshot_length.size
+    values = array("I")
+    end = offset + count * values.itemsize
+    if end > len(view):
+        raise ValueError("Truncated markov snapshot")
+    values.frombytes(view[offset:end])
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values, end
+
+
+def save_snapshot(path, model, state_size, msg_id):
+    """ Write the chain of the model to disk. The file is written next to the destination and
+    moved into place so readers never observe a partial snapshot.
+
+    Layout after the header: the end offsets of the words in the UTF-8 word table, the word table
+    and the states, offsets, follows and counts arrays of encode_chain. The arrays and the table are
+    prefixed by their length.
+
+    :param path:
+    :param model: markovify.Text
+    :param state_size:
+    :param msg_id: The highest msg_id included in the chain
+    """
+    words, states, offsets, follows, counts = encode_chain(model.chain.model)
+    encoded = [w.encode("utf-8") for w in words]
+    word_ends = array("I", accumulate(map(len, encoded)))
+    table = b"".join(encoded)
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "wb") as fp:
+        fp.write(_snapshot_header.pack(_snapshot_magic, SNAPSHOT_VERSION, state_size, msg_id or 0))
+        _write_array(fp, word_ends)
+        fp.write(_snapshot_length.pack(len(table)))
+        fp.write(table)
+        for values in (states, offsets, follows, counts):
+            _write_array(fp, values)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path, state_size):
+    """ Load a snapshot created with save_snapshot. The arrays are copied straight out of the file, the
+    chain is then expanded into a regular markovify chain since new messages are folded into it.
+
+    :param path:
+    :param state_size:
+    :return: (markovify.Text, msg_id) or (None, None) if no compatible snapshot exists
+    """
+    if not exists(path):
+        return None, None
+    with open(path, "rb") as fp:
+        data = fp.read()
+    magic, version, snapshot_state_size, msg_id = _snapshot_header.unpack_from(data)
+    if magic != _snapshot_magic or version != SNAPSHOT_VERSION or snapshot_state_size != state_size:
+        log.warning("Ignoring incompatible markov snapshot: {}".format(path))
+        return None, None
+    with memoryview(data) as view:
+        word_ends, offset = _read_array(view, _snapshot_header.size)
+        size, = _snapshot_length.unpack_from(view, offset)
+        offset += _snapshot_length.size
+        if offset + size > len(view):
+            raise ValueError("Truncated markov snapshot")
+        table = data[offset:offset + size]
+        words = []
+        start = 0
+        for end in word_ends:
+            words.append(table[start:end].decode("utf-8"))
+            start = end
+        offset += size
+        arrays = []
+        for _ in range(4):
+            values, offset = _read_array(view, offset)
+            arrays.append(values)
+    states, offsets, follows, counts = arrays
+    if (not offsets or len(states) != (len(offsets) - 1) * state_size or offsets[-1] != len(follows)
+            or len(counts) != len(follows) or max(max(states, default=-1), max(follows, default=-1)) >= len(words)):
+        raise ValueError("Corrupt markov snapshot")
+    chain_model = decode_chain(words, states, offsets, follows, counts, state_size)
+    if not chain_model:
+        return None, msg_id
+    chain = markovify.Chain(None, state_size, model=chain_model)
+    return markovify.Text(None, state_size=state_size, chain=chain, retain_original=False), msg_id
+
+
 class MarkovModel(object):
     def __init__(self, server_id, state_size=2):
         self.state_size = state_size
         self.model = None
         self.server_id = server_id
-        self._new_data = []
+        # Highest msg_id folded into the chain
+        self.msg_id = 0
+        # Messages received while the chain is being built or used by another thread
+        self._new_data = deque()
+        self._begin_dirty = False
+        self._building = False
+        self._lock = threading.Lock()
+        # Set once a chain has been loaded or built, see ensure_loaded
+        self.loaded = False
+        # Future of the load or build running, see _run_exclusive
+        self._build = None
 
-    def rebuild_chain(self, session: orm.Session):
+    @property
+    def building(self) -> bool:
+        return self._building or self._build is not None
+
+    @staticmethod
+    def _read_messages(session: orm.Session, server_id, since_msg_id=None, max_age=None, max_rows=None):
+        """ Read the message contents of a server, streamed in chunks so only the text is held
+
+        :param since_msg_id: Only messages after this msg_id
+        :param max_age: timedelta, only messages newer than this
+        :param max_rows: Only the most recent max_rows messages
+        :return: (lines, highest msg_id read)
+        """
+        from roboto.model import UserMessage
+        lines = []
+        last_msg_id = since_msg_id or 0
+        for chunk in UserMessage.iter_server_content(session, server_id, since_msg_id, max_age, max_rows):
+            lines.extend(content for _, content in chunk)
+            last_msg_id = chunk[-1][0]
+        return lines, last_msg_id
+
+    @staticmethod
+    def _read_rows(session: orm.Session, server_id, since_msg_id):
+        """ The (msg_id, content) rows of a server recorded after since_msg_id """
         from roboto.model import UserMessage
-        msgs = UserMessage.get_server_msgs(session, self.server_id)
-        self.model = markovify.Text("\n".join([m.content for m in msgs]), state_size=self.state_size)
-        log.debug("Read {} server messages".format(len(msgs)))
+        rows = []
+        for chunk in UserMessage.iter_server_content(session, server_id, since_msg_id):
+            rows.extend(chunk)
+        return rows
+
+    def _swap(self, model, msg_id, replay=()):
+        """ Replace the active model, folding in any messages that were received while it was built
+
+        :param model: markovify.Text
+        :param msg_id: Highest msg_id included in the model
+        :param replay: (msg_id, content) rows newer than msg_id, folded in before the queued messages
+        """
+        with self._lock:
+            self.model = model
+            self.msg_id = msg_id
+            self._begin_dirty = False
+            self._building = False
+            self.loaded = True
+            for row_msg_id, content in replay:
+                self._add(content, row_msg_id)
+            self._flush_pending()
+
+    def snapshot_path(self):
+        """
+
+        :return: Path of the snapshot file or None when snapshots are disabled
+        """
+        path = config.get("markov_snapshot_path")
+        if not path:
+            return None
+        return join(path, "{}.mkv".format(self.server_id))
+
+    def save_snapshot(self) -> bool:
+        path = self.snapshot_path()
+        if not path or self.model is None:
+            return False
+        with self._lock:
+            save_snapshot(path, self.model, self.state_size, self.msg_id)
+        log.debug("Saved markov snapshot {} @ {}".format(path, self.msg_id))
+        return True
+
+    def _run_exclusive(self, build):
+        """ Start build unless a load or build of the chain is already running
+
+        :param build: Coroutine function
+        :return: Future of the running load or build
+        """
+        if self._build is None:
+            self._build = asyncio.ensure_future(build(), loop=loop)
+            self._build.add_done_callback(self._build_done)
+        else:
+            log.debug("Chain build already running for {}".format(self.server_id))
+        return self._build
+
+    def _build_done(self, future):
+        if self._build is future:
+            self._build = None
+
+    async def load_chain(self):
+        """ Load the chain from the servers snapshot and replay only the messages recorded after it
+        was taken. Falls back to a full rebuild when there is no usable snapshot. When a load or build
+        is already running it is waited for instead.
+        """
+        await asyncio.shield(self._run_exclusive(self._load_chain))
+
+    async def _load_chain(self):
+        from roboto.db import database
+        async with get_load_limit():
+            path = self.snapshot_path()
+            model = msg_id = None
+            if path:
+                try:
+                    model, msg_id = await loop.run_in_executor(None, load_snapshot, path, self.state_size)
+                except (OSError, ValueError, struct.error):
+                    log.exception("Failed to load markov snapshot: {}".format(path))
+            if msg_id is None:
+                await self._rebuild()
+                return
+            # Messages recorded while the replay is read are queued and folded in after the swap
+            self._building = True
+            try:
+                rows = await database.run_in_session(self._read_rows, self.server_id, msg_id)
+            except Exception:
+                self._building = False
+                raise
+            self._swap(model, msg_id, rows)
+            log.debug("Loaded markov snapshot {} replayed {} messages".format(path, len(rows)))
+            if rows:
+                await loop.run_in_executor(None, self.save_snapshot)
+
+    async def ensure_loaded(self):
+        """ Load the chain if it hasn't been yet. Concurrent callers, and callers arriving while a
+        rebuild is running, share that single load or build. The number of loads running at once
+        across all servers is bounded by get_load_limit.
+        """
+        if not self.loaded:
+            await self.load_chain()
+
+    def rebuild_chain(self, session: orm.Session):
+        """ Fully rebuild the chain from the stored messages of the server within the corpus window.
+        This is only required on demand, new messages should be folded in using add_message.
+
+        :param session:
+        """
+        max_age, max_rows = corpus_window()
+        lines, msg_id = self._read_messages(session, self.server_id, max_age=max_age, max_rows=max_rows)
+        self._swap(build_model(lines, self.state_size), msg_id)
+        log.debug("Read {} server messages".format(len(lines)))
+        self.save_snapshot()
+
+    async def rebuild_chain_async(self):
+        """ Fully rebuild the chain in a worker process, the current model continues to serve
+        requests until the new one is swapped in. The messages are read in the database thread pool.
+        When a load or build is already running it is waited for instead.
+        """
+        await asyncio.shield(self._run_exclusive(self._rebuild))
+
+    async def _rebuild(self):
+        from roboto.db import database
+        if not executor_enabled():
+            return await database.run_in_session(self.rebuild_chain)
+        self._building = True
+        try:
+            lines, msg_id = await database.run_in_session(
+                self._read_messages, self.server_id, None, *corpus_window())
+            async with get_build_limit():
+                model = await loop.run_in_executor(get_build_executor(), build_model, lines, self.state_size)
+        except Exception:
+            self._building = False
+            raise
+        self._swap(model, msg_id)
+        log.debug("Read {} server messages".format(len(lines)))
+        await loop.run_in_executor(None, self.save_snapshot)
+
+    def add_message(self, content: str, msg_id=None) -> bool:
+        """ Fold a single message into the existing transition counts of the chain. If the chain is
+        being rebuilt or is in use by a generator thread the message is queued and applied later.
+
+        :param content: Raw message content
+        :param msg_id: msg_id of the stored message, messages already included in the chain are skipped
+        :return: True if the chain was updated immediately
+        """
+        if self._building or not self._lock.acquire(blocking=False):
+            self._new_data.append((content, msg_id))
+            return False
+        try:
+            self._flush_pending()
+            return self._add(content, msg_id)
+        finally:
+            self._lock.release()
+
+    def _flush_pending(self):
+        while self._new_data:
+            self._add(*self._new_data.popleft())
+
+    def _add(self, content: str, msg_id=None) -> bool:
+        if msg_id:
+            if msg_id <= self.msg_id:
+                return False
+            self.msg_id = msg_id
+        if self.model is None:
+            self.model = build_model([content], self.state_size)
+            return self.model is not None
+        chain = self.model.chain
+        updated = False
+        for run in self.model.generate_corpus(content):
+            items = ([BEGIN] * self.state_size) + run + [END]
+            for i in range(len(run) + 1):
+                state = tuple(items[i:i + self.state_size])
+                follow = items[i + self.state_size]
+                next_words = chain.model.setdefault(state, {})
+                next_words[follow] = next_words.get(follow, 0) + 1
+            updated = True
+        if updated:
+            # The cached begin state distribution is recomputed lazily on the next generation
+            self._begin_dirty = True
+        return updated
+
+    def _refresh(self) -> bool:
+        if not self._building:
+            self._flush_pending()
+        if self.model is None:
+            return False
+        if self._begin_dirty:
+            self.model.chain.precompute_begin_state()
+            self._begin_dirty = False
+        return True
 
     def make_sentence_with_start(self, start):
-        return self.model.make_sentence_with_start(start)
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self.model.make_sentence_with_start(start)
 
     def make_sentence(self, tries=20):
-        return self.model.make_sentence(tries=tries)
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self.model.make_sentence(tries=tries)
+
+    async def make_sentence_with_start_async(self, start):
+        if not executor_enabled():
+            return self.make_sentence_with_start(start)
+        return await loop.run_in_executor(get_generate_executor(), self.make_sentence_with_start, start)
+
+    async def make_sentence_async(self, tries=20):
+        if not executor_enabled():
+            return self.make_sentence(tries=tries)
+        return await loop.run_in_executor(get_generate_executor(), self.make_sentence, tries)
 
 
 def normalize(t):
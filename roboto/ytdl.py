@@ -0,0 +1,209 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from roboto import config, loop
+from roboto.exc import ExtractError
+
+log = getLogger(__name__)
+
+ytdl_options = {
+    'format': 'webm[abr>0]/bestaudio/best',
+    'noplaylist': True,
+    'quiet': True
+}
+
+# Hosts that serve the same videos, mapped to a single name for the cache key
+host_aliases = {
+    "youtube.com": "youtube.com",
+    "www.youtube.com": "youtube.com",
+    "m.youtube.com": "youtube.com",
+    "music.youtube.com": "youtube.com",
+    "youtu.be": "youtube.com"
+}
+
+# Query parameters that don't change which media a URL points to
+ignored_params = {"t", "feature", "si", "pp", "index", "ab_channel"}
+
+
+def normalize_url(url: str) -> str:
+    """ Normalize a media URL so variants pointing to the same media share a cache entry. Short
+    youtu.be links are expanded and query parameters that don't select the media are removed.
+
+    :param url:
+    :rtype: str
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    host = host_aliases.get(host, host[4:] if host.startswith("www.") else host)
+    path = parts.path.rstrip("/") or "/"
+    args = [(k, v) for k, v in parse_qsl(parts.query) if k not in ignored_params and not k.startswith("utm_")]
+    if parts.netloc.lower() == "youtu.be":
+        args.insert(0, ("v", path.lstrip("/")))
+        path = "/watch"
+    elif host == "youtube.com" and path == "/watch":
+        args = [(k, v) for k, v in args if k == "v"]
+    return urlunsplit(("https", host, path, urlencode(sorted(args)), ""))
+
+
+def url_expiry(download_url: str):
+    """ The unix time a signed stream URL expires, as given by its expire query parameter
+
+    :return: float or None when the URL doesn't carry an expiry
+    """
+    for key, value in parse_qsl(urlsplit(download_url).query):
+        if key == "expire":
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+def youtube_dl_extractor(url: str) -> dict:
+    """ Extract the media info for url with youtube-dl, this blocks on the network """
+    import youtube_dl
+    # YoutubeDL instances aren't safe to share between threads
+    return youtube_dl.YoutubeDL(ytdl_options).extract_info(url, download=False)
+
+
+class StreamInfo(object):
+    """
+    The parts of a youtube-dl extraction needed to play the stream
+    """
+    __slots__ = ("url", "download_url", "title", "duration", "is_live", "expires")
+
+    def __init__(self, url, download_url, title=None, duration=None, is_live=False, expires=0.0):
+        self.url = url
+        self.download_url = download_url
+        self.title = title
+        self.duration = duration
+        self.is_live = is_live
+        self.expires = expires
+
+    @classmethod
+    def from_info(cls, url, info: dict, expires=0.0):
+        if "entries" in info:
+            entries = list(info["entries"])
+            if not entries:
+                raise ExtractError("No media found")
+            info = entries[0]
+        if not info.get("url"):
+            raise ExtractError("No stream URL found")
+        if "twitch" in url:
+            # twitch has 'title' and 'description' mixed up
+            title = info.get("description")
+        else:
+            title = info.get("title")
+        return cls(url, info["url"], title, info.get("duration"), bool(info.get("is_live")), expires)
+
+
+class ExtractCache(object):
+    """
+    Cache of youtube-dl extractions keyed by the normalized URL. Entries expire after ttl seconds, or
+    earlier when the signed stream URL expires first. Extractions run in a bounded thread pool and
+    concurrent requests for the same URL share one extraction.
+
+    The extractor is any callable taking a URL and returning a youtube-dl info dict.
+    """
+
+    def __init__(self, extractor=youtube_dl_extractor, ttl=3600.0, expiry_margin=60.0, workers=2, max_size=256):
+        self.extractor = extractor
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        self.workers = workers
+        self.max_size = max_size
+        self._executor = None
+        self._cache = dict()
+        self._in_flight = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self):
+        self.ttl = float(config.get("ytdl_cache_ttl", self.ttl))
+        self.workers = int(config.get("ytdl_workers", self.workers))
+        self.max_size = int(config.get("ytdl_cache_size", self.max_size))
+
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def get(self, url):
+        """ The cached extraction of url if it's still valid
+
+        :rtype: StreamInfo
+        """
+        key = normalize_url(url)
+        info = self._cache.get(key)
+        if info is not None and info.expires <= time.time():
+            del self._cache[key]
+            return None
+        return info
+
+    async def resolve(self, url) -> StreamInfo:
+        """ Extract url, or take it from the cache
+
+        :param url:
+        :rtype: StreamInfo
+        :raises ExtractError: if nothing playable was found
+        """
+        info = self.get(url)
+        if info is not None:
+            self.hits += 1
+            return info
+        self.misses += 1
+        key = normalize_url(url)
+        fetch = self._in_flight.get(key)
+        if fetch is None:
+            fetch = self._in_flight[key] = asyncio.ensure_future(self._extract(key, url), loop=loop)
+            fetch.add_done_callback(lambda f: self._in_flight.pop(key, None))
+        return await asyncio.shield(fetch)
+
+    def prefetch(self, url):
+        """ Resolve url in the background so a later resolve is answered from the cache """
+        if self.get(url) is not None or normalize_url(url) in self._in_flight:
+            return
+        fetch = asyncio.ensure_future(self.resolve(url), loop=loop)
+        fetch.add_done_callback(self._prefetch_done)
+
+    @staticmethod
+    def _prefetch_done(fetch: asyncio.Future):
+        if not fetch.cancelled() and fetch.exception() is not None:
+            log.warning("Failed to prefetch media info: {}".format(fetch.exception()))
+
+    async def _extract(self, key, url) -> StreamInfo:
+        try:
+            info = await loop.run_in_executor(self.executor(), self.extractor, url)
+        except ExtractError:
+            raise
+        except Exception as err:
+            raise ExtractError(str(err)) from err
+        if not info:
+            raise ExtractError("No media found")
+        stream = StreamInfo.from_info(url, info)
+        expires = time.time() + self.ttl
+        url_expires = url_expiry(stream.download_url)
+        if url_expires is not None:
+            expires = min(expires, url_expires - self.expiry_margin)
+        stream.expires = expires
+        self._cache.pop(key, None)
+        self._cache[key] = stream
+        while len(self._cache) > self.max_size:
+            del self._cache[next(iter(self._cache))]
+        return stream
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._cache),
+            "in_flight": len(self._in_flight),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+cache = ExtractCache()
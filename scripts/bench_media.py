@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+""" Compare the memory used by the array backed MediaCatalog against the previous list of
+MediaFile objects for a synthetic library.
+
+    python scripts/bench_media.py [tracks]
+"""
+import sys
+import tracemalloc
+from os.path import join
+
+
+class LegacyMediaFile(object):
+    """ MediaFile as it was before the catalog, kept here for comparison """
+
+    def __init__(self, path, idx=0):
+        self.path = path
+        self.idx = idx
+
+
+def gen_entries(tracks, per_album=12, albums_per_artist=5):
+    entries = []
+    for i in range(tracks):
+        album = i // per_album
+        artist = album // albums_per_artist
+        rel_dir = join("Artist {:05d}".format(artist), "Album {:06d}".format(album))
+        entries.append((rel_dir, "{:02d} - Some Track Title {}.flac".format(i % per_album + 1, i), i))
+    entries.sort(key=lambda e: join(e[0], e[1]))
+    return entries
+
+
+def measure(fn):
+    tracemalloc.start()
+    result = fn()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def build_legacy(entries):
+    files = [LegacyMediaFile(join(rel_dir, name)) for rel_dir, name, _ in entries]
+    for idx, f in enumerate(files):
+        f.song_id = idx
+    return files
+
+
+def main():
+    from roboto.library import MediaCatalog
+    tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    entries = gen_entries(tracks)
+    legacy, legacy_size = measure(lambda: build_legacy(entries))
+    catalog, catalog_size = measure(lambda: MediaCatalog(entries))
+    assert [f.path for f in legacy[:100]] == [f.path for f in catalog[:100]]
+    print("tracks:  {}".format(tracks))
+    print("list:    {:>8.1f} MiB".format(legacy_size / 1024 / 1024))
+    print("catalog: {:>8.1f} MiB".format(catalog_size / 1024 / 1024))
+    print("ratio:   {:>8.1f}x".format(legacy_size / max(catalog_size, 1)))
+
+
+if __name__ == "__main__":
+    main()
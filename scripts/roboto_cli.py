@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import logging
 from irc3 import IrcBot
 from irc3.utils import parse_config
 
 
 def main():
-    from roboto import model, http, loop, disc, config, commands
+    from roboto import model, http, loop, disc, config, commands, text, state, recorder, overwatch, library, ytdl, \
+        media, retention, db, outbound, cooldown, stats
 
     # Parse & load config file
     config.update(parse_config('bot', "config.ini"))
+    commands.registry.load(commands.dispatcher)
+    overwatch.client.configure()
+    ytdl.cache.configure()
 
     # Connect & Init DB
     model.init_db(config)
+    db.database.configure()
 
     # Load IRC Bot
     irc_bot = IrcBot.from_config(config, loop=loop)
@@ -21,10 +27,63 @@ def main():
     http.setup()
 
     # Start background task queue processor
+    commands.dispatcher.configure()
     asyncio.ensure_future(commands.dispatcher.task_consumer(), loop=loop)
 
-    # Start discord client
-    disc.dc.run(config.get("discord_token"))
+    # Discover the external address used in playlist links
+    media.public_address.configure()
+    asyncio.ensure_future(media.public_address.run(), loop=loop)
+
+    # Keep the media library index up to date
+    asyncio.ensure_future(library.get_library().run(float(config.get("media_scan_interval", 600))), loop=loop)
+
+    # Start write-behind message recorder
+    recorder.recorder.configure()
+    asyncio.ensure_future(recorder.recorder.run(), loop=loop)
+
+    # Prune messages outside of the retention policy
+    retention.pruner.configure()
+    asyncio.ensure_future(retention.pruner.run(), loop=loop)
+
+    # Rate limits of the outgoing chat messages
+    outbound.outbox.configure()
+    # Flood control of the incoming commands
+    cooldown.cooldowns.configure()
+
+    # Write changed voice channels in batches
+    asyncio.ensure_future(state.servers.run_voice_writer(float(config.get("voice_state_interval", 5))), loop=loop)
+
+    # Release the markov models and media players of idle servers
+    state.servers.configure()
+    asyncio.ensure_future(state.servers.run_evictor(float(config.get("evict_interval", 60))), loop=loop)
+
+    # Log the counters of the components every stats_interval seconds
+    stats.reporter.configure()
+    for name, source in (("dispatcher", commands.dispatcher.stats), ("db", db.database.stats),
+                         ("recorder", recorder.recorder.stats), ("outbox", outbound.outbox.stats),
+                         ("cooldowns", cooldown.cooldowns.stats), ("ytdl_cache", ytdl.cache.stats),
+                         ("user_cache", model.user_cache.stats), ("servers", state.servers.stats),
+                         ("retention", retention.pruner.stats)):
+        stats.reporter.register(name, source)
+    asyncio.ensure_future(stats.reporter.run(), loop=loop)
+
+    # Start discord client, the loop is driven here rather than by dc.run so it's still open for the
+    # async cleanup below
+    try:
+        loop.run_until_complete(disc.dc.start(config.get("discord_token")))
+    except KeyboardInterrupt:
+        loop.run_until_complete(disc.dc.logout())
+    finally:
+        try:
+            loop.run_until_complete(overwatch.client.close())
+        except Exception:
+            logging.exception("Failed to close the overwatch client")
+        recorder.recorder.close()
+        state.servers.save_voice_states()
+        state.servers.save_markov_snapshots()
+        text.shutdown_executors()
+        db.database.shutdown()
+        loop.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import unittest
+from roboto import loop, Config
+from roboto.db import Database
+from roboto.model import init_db, Server, Session
+
+
+class TestDatabase(unittest.TestCase):
+
+    def test_default_dsn(self):
+        # The default in-memory database must be shared by all the threads of the pool
+        init_db(Config())
+        database = Database(workers=4)
+        database.configure()
+
+        def add(session, server_id):
+            Server.get(session, server_id, create=True)
+
+        async def run():
+            for i in range(8):
+                await database.run_in_session(add, str(i))
+            return [await database.run_in_session(Server.get_voice_channel_id, str(i)) for i in range(8)]
+
+        try:
+            self.assertEqual(loop.run_until_complete(run()), [None] * 8)
+            self.assertEqual(loop.run_until_complete(database.run(self.count_servers)), 8)
+        finally:
+            database.shutdown()
+
+    @staticmethod
+    def count_servers():
+        session = Session()
+        try:
+            return session.query(Server).count()
+        finally:
+            session.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
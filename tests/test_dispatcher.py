@@ -0,0 +1,77 @@
+import asyncio
+import unittest
+# disc first, like the bot does, commands can't be imported on its own because of the import cycle
+from roboto import disc, loop, config  # noqa: F401
+from roboto.commands import CommandDispatcher, TaskState, TaskPriority, Commands, admin, coalescible, \
+    task_priority, registry, dispatcher
+from roboto.model import TaskSource
+
+
+class RebuildDispatcher(CommandDispatcher):
+    """ Counts the rebuilds instead of running them """
+
+    def __init__(self):
+        super().__init__(loop, workers=2)
+        self.rebuilds = []
+
+    @admin
+    @task_priority(TaskPriority.background)
+    @coalescible(debounce=0.1, max_delay=0.3)
+    async def do_rebuild_markov(self, task: TaskState):
+        self.rebuilds.append(task.server_id)
+
+
+def rebuild_task(user="1", server_id="1"):
+    return TaskState(Commands.rebuild_markov, [], server_id=server_id, source=TaskSource.discord, channel="1",
+                     user=user)
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def setUp(self):
+        config["discord_admins"] = "1"
+        self.dispatcher = RebuildDispatcher()
+        registry.load(self.dispatcher)
+        self.consumer = asyncio.ensure_future(self.dispatcher.task_consumer(), loop=loop)
+
+    def tearDown(self):
+        self.consumer.cancel()
+        loop.run_until_complete(asyncio.sleep(0))
+        del config["discord_admins"]
+        registry.load(dispatcher)
+
+    def test_burst(self):
+        async def run():
+            queued = [await self.dispatcher.add_task(rebuild_task()) for _ in range(10)]
+            queued.append(await self.dispatcher.add_task(rebuild_task(server_id="2")))
+            await asyncio.sleep(0.5)
+            return queued
+
+        queued = loop.run_until_complete(run())
+        self.assertEqual(queued, [True] + [False] * 9 + [True])
+        self.assertEqual(sorted(self.dispatcher.rebuilds), ["1", "2"])
+        self.assertEqual(self.dispatcher.merged, 9)
+
+    def test_max_delay(self):
+        async def run():
+            # Requests keep arriving within the debounce period, the held task still runs by max_delay
+            for _ in range(12):
+                await self.dispatcher.add_task(rebuild_task())
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(0.3)
+
+        loop.run_until_complete(run())
+        self.assertEqual(len(self.dispatcher.rebuilds), 2)
+
+    def test_admin_only(self):
+        async def run():
+            queued = await self.dispatcher.add_task(rebuild_task(user="2"))
+            await asyncio.sleep(0.3)
+            return queued
+
+        self.assertFalse(loop.run_until_complete(run()))
+        self.assertEqual(self.dispatcher.rebuilds, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import tempfile
+import unittest
+from roboto.library import MediaCatalog, MediaIndex
+
+
+class TestMediaCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = MediaCatalog([("a", "01.flac", 1), ("a", "02.flac", 3), ("b", "01.mp3", 2)])
+
+    def test_position(self):
+        self.assertEqual([self.catalog.position(i) for i in (1, 3, 2)], [0, 1, 2])
+        self.assertIsNone(self.catalog.position(0))
+        self.assertIsNone(self.catalog.position(4))
+        self.assertIsNone(self.catalog.position("1"))
+
+    def test_negative_id(self):
+        # Must not wrap around to the end of the positions array
+        for song_id in (-1, -2, -4, -100):
+            self.assertIsNone(self.catalog.position(song_id))
+
+
+
+class TestMediaIndex(unittest.TestCase):
+
+    def test_symlink_cycle(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, "artist", "album"))
+            open(os.path.join(root, "artist", "album", "01.mp3"), "w").close()
+            os.symlink(os.path.join(root, "artist"), os.path.join(root, "artist", "album", "loop"))
+            result = MediaIndex(root).scan()
+        self.assertEqual(sorted(result.dirs), ["", "artist", "artist/album"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+from roboto import loop
+from roboto.outbound import RateLimit, ChannelSender
+
+
+def send_times(limit: RateLimit, count):
+    """ Send count messages as fast as the limit allows using a fake clock """
+    now = 0.0
+    times = []
+    for _ in range(count):
+        now += limit.delay(now)
+        limit.record(now)
+        times.append(now)
+    return times
+
+
+def max_in_window(times, period):
+    return max(sum(1 for t in times if start <= t < start + period) for start in times)
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_twitch(self):
+        times = send_times(RateLimit(20, 30.0), 100)
+        self.assertEqual(max_in_window(times, 30.0), 20)
+        self.assertEqual(sum(1 for t in times if t < 30.0), 20)
+
+    def test_discord(self):
+        times = send_times(RateLimit(5, 5.0), 50)
+        self.assertEqual(max_in_window(times, 5.0), 5)
+        self.assertEqual(sum(1 for t in times if t < 5.0), 5)
+
+    def test_spread(self):
+        limit = RateLimit(3, 10.0)
+        for now in (0.0, 4.0, 8.0):
+            self.assertEqual(limit.delay(now), 0.0)
+            limit.record(now)
+        self.assertEqual(limit.delay(9.0), 1.0)
+        self.assertEqual(limit.delay(10.0), 0.0)
+        self.assertEqual(limit.time_to_clear(10.0), 8.0)
+
+    def test_sender(self):
+        sent = []
+
+        async def deliver(line):
+            sent.append((loop.time(), line))
+
+        async def run():
+            sender = ChannelSender(deliver, RateLimit(3, 0.3), merge_length=0)
+            for i in range(7):
+                sender.put(str(i))
+            while len(sent) < 7 or sender._task is not None:
+                await asyncio.sleep(0.05)
+
+        loop.run_until_complete(run())
+        self.assertEqual([line for _, line in sent], [str(i) for i in range(7)])
+        times = [t for t, _ in sent]
+        # Allow for timer granularity of the event loop
+        self.assertLessEqual(max_in_window(times, 0.29), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()